@@ -7,16 +7,32 @@ import socket
 import random
 import pygame
 import sys
+import argparse
+import selectors
+from collections import deque
 from pygame.locals import *
-import json
-import threading
+from networmy_protocol import (encode_frame, decode, FrameReader, new_board, apply_board_update, ProtocolError,
+                               UDP_REDUNDANCY, unpack_state_datagram, pack_input_datagram, clock_ms, elapsed_ms)
+from networmy_render import BoardRenderer
+from networmy_metrics import Samples
 import queue
-from time import sleep
+from time import sleep, monotonic
 
 HOST = "10.157.0.60"
 PORT = 65432
 
-FPS = 128
+parser = argparse.ArgumentParser(description='Play networmy.')
+parser.add_argument('match', type=int, nargs='?', default=0,
+                    help="tournament match to join (default: 0, the host's own game)")
+parser.add_argument('--host', default=HOST,
+                    help=f'address of the host, the game code it shows (default: {HOST})')
+parser.add_argument('--port', type=int, default=PORT,
+                    help=f'port of the host (default: {PORT})')
+parser.add_argument('--udp', action='store_true',
+                    help='ask the host for board updates and turns over UDP, TCP is used when it has none')
+ARGS = None # parsed by main(), nothing connects before that
+
+MAX_FPS = 60 # frames drawn per second at most; a frame is only drawn when the board changed
 WINDOWWIDTH = 1600
 WINDOWHEIGHT = 900
 CELLSIZE = 20
@@ -25,10 +41,45 @@ assert WINDOWHEIGHT % CELLSIZE == 0, "Window height must be a multiple of cell s
 CELLWIDTH = int(WINDOWWIDTH / CELLSIZE)
 CELLHEIGHT = int(WINDOWHEIGHT / CELLSIZE)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((HOST, PORT))
-s.settimeout(1.0)
-print(f"Connection established with {HOST}:{PORT}")
+RECONNECT_TIMEOUT = 10 # seconds a client whose connection dropped keeps trying to get back in
+UDP_HELLO_INTERVAL = 1.0 # seconds between hellos until the host's first state datagram arrives
+RESYNC_INTERVAL = 0.25 # seconds between requests for a keyframe while the UDP updates do not fit the board
+# Seconds the loop sleeps at most before it looks at the keyboard again: SDL has no file
+# descriptor the selector could wait on for key presses. Without the keyboard focus no key can
+# arrive, and a window in the background only wakes for the host and the caption.
+INPUT_POLL_INTERVAL = 0.008
+UNFOCUSED_POLL_INTERVAL = 0.25
+
+s = None
+sessionToken = 0 # from the start message, gets us our snake back after a reconnect
+
+def connect():
+    global s, reader
+    newSocket = socket.create_connection((HOST, PORT), timeout=1.0)
+    newSocket.sendall(encode_frame({'type': 'join', 'match': ARGS.match, 'token': sessionToken}))
+    if ARGS.udp:
+        newSocket.sendall(encode_frame({'type': 'udp', 'token': 0}))
+    if s is not None:
+        s.close()
+    s = newSocket
+    reader = FrameReader() # frames from the host
+    print(f"Connection established with {HOST}:{PORT}")
+
+def reconnect():
+    # Dials the host again until RECONNECT_TIMEOUT runs out. The join message presents the
+    # session token, so the host puts us back on our snake and sends the board right away.
+    global udpActive
+    deadline = monotonic() + RECONNECT_TIMEOUT
+    delay = 0.05
+    while monotonic() < deadline:
+        try:
+            connect()
+            udpActive = False # the new connection gets a UDP channel of its own
+            return True
+        except OSError:
+            sleep(delay)
+            delay = min(delay * 2, 1.0)
+    return False
 
 #             R    G    B
 WHITE     = (255, 255, 255)
@@ -46,9 +97,35 @@ RIGHT = 3
 
 HEAD = 0 # syntactic sugar: index of the worm's head
 direction = RIGHT
+TURN_KEYS = {K_w: UP, K_a: LEFT, K_s: DOWN, K_d: RIGHT}
+
+# UDP state channel, once the host granted one
+udpSocket = None
+udpToken = None
+udpActive = False # a state datagram arrived, turns go over UDP too
+udpSequence = 0 # newest state datagram taken
+udpHelloDue = 0 # when to send the next hello while no state datagram arrived
+resyncDue = 0 # when the board may ask for a keyframe again
+inputSequence = 0
+recentInputs = deque(maxlen=UDP_REDUNDANCY) # repeated in every input datagram
+selector = selectors.DefaultSelector() # the TCP connection and the UDP channel
+
+gameStarted = False
+board = new_board()  # local copy of the host's board, kept in sync by board_update messages
+# missed: deltas that arrived after a gap, superseded: updates replaced before they were drawn
+stats = {'updates': 0, 'missed': 0, 'superseded': 0, 'undrawn': 0, 'stale': 0}
+# a turn's round trip until the host applied it, and until a frame showing that tick was drawn
+inputLatency = Samples()
+screenLatency = Samples()
+appliedInputs = deque() # (tick, time sent) of applied turns not drawn yet
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, ARGS, HOST, PORT
+
+    ARGS = parser.parse_args()
+    HOST, PORT = ARGS.host, ARGS.port
+    connect()
+    selector.register(s, selectors.EVENT_READ)
 
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
@@ -60,88 +137,211 @@ def main():
     runGame()
 
 def runGame():
-    snakes = []
-    running = True
-
-    def receive_updates():
-        while running:
-            FPSCLOCK.tick(FPS)
-
-            print("Receiving updates")
-            try:
-                buffer = ''
-                while True:
-                    data = s.recv(1024)
-                    if not data:
-                        print("No data")
-                        continue
-                    buffer += data.decode()
-                    while '\n' in buffer:
-                        message, buffer = buffer.split('\n', 1)
-                        message = json.loads(message)
-                        print(f"Received message: {message}")
-                        if message['type'] == 'board_update':
-                            snakes = message['snakes']
-                            print(snakes)
-                            # drawApple(snake['apple'])
-                            # drawScore(snake['score'])
-                            drawGrid()
-                            for snake in json.loads(str(snakes)):
-                                drawWorm(snake['coords'], snake['color'])
-            except socket.timeout:
-                print("Timeout")
-                continue
-            except Exception as e:
-                print(f"Error while receivingd: {e}")
-                break
-    receive_thread = threading.Thread(target=receive_updates)
-    receive_thread.start()
+    # One loop on the main thread does everything: it sleeps in the selector until the host
+    # sends something, the next look at the keyboard or the next frame is due. Turns are sent
+    # before anything is drawn, and a frame is only drawn when the board changed, at most
+    # MAX_FPS times a second.
+    global direction
+    renderer = BoardRenderer(DISPLAYSURF, CELLSIZE, BGCOLOR, DARKGRAY)
+    renderer.reset()
+    nextFrame = 0.0
+    frameTime = 0.0
+    nextReport = monotonic() + 1
 
     print("Sending direction")
-    inputQueue = []
-    while running:
-        FPSCLOCK.tick(FPS)
+    while True:
+        timeout = INPUT_POLL_INTERVAL if pygame.key.get_focused() else UNFOCUSED_POLL_INTERVAL
+        if stats['undrawn']:
+            timeout = min(timeout, nextFrame - monotonic())
+        poll_network(min(timeout, nextReport - monotonic()))
         for event in pygame.event.get():
             if event.type == QUIT:
-                s.sendall(json.dumps({'type': 'quit'}).encode())
+                s.sendall(encode_frame({'type': 'quit'}))
                 print("Sent quit message")
                 terminate()
             elif event.type == KEYDOWN:
-                if event.key == K_w:
-                    direction = UP
-                elif event.key == K_a:
-                    direction = LEFT
-                elif event.key == K_s:
-                    direction = DOWN
-                elif event.key == K_d:
-                    direction = RIGHT
-                elif event.key == K_ESCAPE:
-                    s.sendall(json.dumps({'type': 'quit'}).encode())
-                s.sendall((json.dumps({'type': 'direction', 'direction': direction})).encode())
-                print(f"Sent direction: {json.dumps({'type': 'direction', 'direction': direction})}")
-            else:
-                continue
-    
-    
-    receive_thread.join()
+                if event.key == K_ESCAPE:
+                    s.sendall(encode_frame({'type': 'quit'}))
+                elif event.key in TURN_KEYS:
+                    # other keys send nothing; the host limits how many messages a client may send
+                    direction = TURN_KEYS[event.key]
+                    send_direction(direction)
+                    print(f"Sent direction: {direction}")
+
+        now = monotonic()
+        if stats['undrawn'] and now >= nextFrame:
+            # Draw whatever changed since the last frame and flip once
+            renderer.draw_board(board)
+            renderer.flush()
+            stats['superseded'] += stats['undrawn'] - 1
+            stats['undrawn'] = 0
+            nextFrame = now + 1 / MAX_FPS
+            drawn = monotonic()
+            frameTime += ((drawn - now) * 1000 - frameTime) * 0.1  # moving average of the ms spent drawing a frame
+            while appliedInputs and board['tick'] is not None and appliedInputs[0][0] <= board['tick']:
+                screenLatency.add(elapsed_ms(appliedInputs.popleft()[1], clock_ms(drawn)) / 1000)
+
+        if now >= nextReport:
+            nextReport = now + 1
+            caption = (f"Wormy - frame {frameTime:.1f} ms, updates {stats['updates']}, "
+                       f"dropped {stats['missed'] + stats['superseded']}")
+            if inputLatency.values:
+                caption += (f", input {inputLatency.percentile(50) * 1000:.0f} ms"
+                            f" ({screenLatency.percentile(50) * 1000 if screenLatency.values else 0:.0f} ms to screen)")
+            pygame.display.set_caption(caption)
+
+def poll_network(timeout):
+    # Waits up to timeout seconds for the host, then handles whatever arrived on the TCP
+    # connection and the UDP channel
+    global udpHelloDue
+    if udpSocket is not None and not udpActive:
+        if monotonic() >= udpHelloDue:
+            send_datagram() # the hello that tells the host where we are
+            udpHelloDue = monotonic() + UDP_HELLO_INTERVAL
+        timeout = min(timeout, udpHelloDue - monotonic())
+    for key, mask in selector.select(max(timeout, 0)):
+        if key.fileobj is udpSocket:
+            receive_datagram()
+            continue
+        try:
+            receive_frames()
+        except (OSError, ProtocolError) as e:
+            print(f"Connection lost ({e}), reconnecting")
+            selector.unregister(key.fileobj)
+            if not reconnect():
+                print("Could not reconnect")
+                terminate()
+            selector.register(s, selectors.EVENT_READ)
+
+def receive_frames():
+    global gameStarted
+    if reader.fill(s) == 0:
+        raise ConnectionResetError('connection closed by host')
+    for payload in reader.frames():
+        message = decode(payload)
+        if message['type'] == 'board_update':
+            apply_update(message)
+        elif message['type'] == 'game_over':
+            winner = message['winner']
+            print(f"Match over, won by snake {winner}" if winner is not None else "Match over, nobody survived")
+            board['tick'] = None # the next match counts its ticks from 0 again
+        elif message['type'] == 'udp':
+            start_udp(message['token'])
+        elif message['type'] == 'start':
+            if not gameStarted:
+                print("Game starting")
+                gameStarted = True
+            set_session(message)
+        elif message['type'] == 'ping':
+            answer_ping(message)
+        elif message['type'] == 'input_applied':
+            inputLatency.add(elapsed_ms(message['time'], clock_ms(monotonic())) / 1000)
+            appliedInputs.append((message['tick'], message['time']))
+
+def receive_datagram():
+    # Datagrams can arrive late, twice or not at all: older sequence numbers are skipped, and
+    # of the updates repeated in a datagram only those newer than the board are applied
+    global udpActive, udpSequence
+    try:
+        data = udpSocket.recv(65535)
+    except OSError:
+        return # e.g. the port unreachable until the host has a UDP channel
+    try:
+        sequence, payloads = unpack_state_datagram(data)
+        if sequence <= udpSequence:
+            stats['stale'] += 1
+            return
+        udpSequence = sequence
+        udpActive = True
+        for payload in payloads:
+            message = decode(payload)
+            if board['tick'] is not None and message['tick'] <= board['tick']:
+                continue # applied from an earlier datagram
+            if not apply_update(message):
+                request_keyframe() # more updates were lost than the datagram repeats
+                break
+    except ProtocolError as e:
+        print(f"Bad datagram: {e}")
+
+def apply_update(message):
+    if not apply_board_update(board, message):
+        stats['missed'] += 1
+        return False
+    stats['updates'] += 1
+    stats['undrawn'] += 1
+    return True
+
+def request_keyframe():
+    # Without it the board would wait for the host's next periodic keyframe. The request goes
+    # over TCP; it is repeated after RESYNC_INTERVAL in case the keyframe was lost as well.
+    global resyncDue
+    if monotonic() < resyncDue:
+        return
+    resyncDue = monotonic() + RESYNC_INTERVAL
+    try:
+        s.sendall(encode_frame({'type': 'resync'}))
+    except OSError:
+        pass # the selectors loop finds the socket closed on its next read and reconnects
+
+def start_udp(token):
+    global udpSocket, udpToken, udpSequence, udpHelloDue
+    udpToken = token
+    udpSequence = 0 # a new channel counts from the start
+    udpHelloDue = 0 # right away
+    if udpSocket is None:
+        udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udpSocket.connect((HOST, PORT))
+        udpSocket.setblocking(False)
+        selector.register(udpSocket, selectors.EVENT_READ)
+
+def set_session(message):
+    global sessionToken
+    sessionToken = message['token']
+    if sessionToken:
+        print(f"Playing snake {message['id']}")
+    else:
+        print("Watching the game")
+
+def send_direction(direction):
+    global inputSequence
+    if not udpActive:
+        try:
+            s.sendall(encode_frame({'type': 'direction', 'direction': direction, 'sent': clock_ms(monotonic())}))
+        except OSError as e:
+            print(f"Error sending direction: {e}") # the selectors loop finds the socket closed on its next read and reconnects
+        return
+    inputSequence += 1
+    recentInputs.append(direction)
+    send_datagram()
+
+def answer_ping(message):
+    # The host measures the round trip from the time it put in the ping
+    try:
+        s.sendall(encode_frame({'type': 'pong', 'time': message['time']}))
+    except OSError:
+        pass # the selectors loop finds the socket closed on its next read and reconnects
+
+def send_datagram():
+    # The last few inputs; with none yet it only tells the host our UDP address
+    try:
+        udpSocket.send(pack_input_datagram(udpToken, inputSequence, recentInputs))
+    except OSError as e:
+        print(f"Error sending datagram: {e}")
 
 def updateBoard(snake):
     for segment in snake:
         wormCoords = segment['coords']
         drawWorm(wormCoords)
     pygame.display.update()
-    FPSCLOCK.tick(FPS)
 
 def drawWorm(wormCoords, color):
-    for coord in wormCoords:
-        x = coord['x'] * CELLSIZE
-        y = coord['y'] * CELLSIZE
+    for cellx, celly in wormCoords:
+        x = cellx * CELLSIZE
+        y = celly * CELLSIZE
         wormSegmentRect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
         pygame.draw.rect(DISPLAYSURF, DARKGREEN, wormSegmentRect)
         wormInnerSegmentRect = pygame.Rect(x + 4, y + 4, CELLSIZE - 8, CELLSIZE - 8)
         pygame.draw.rect(DISPLAYSURF, GREEN, wormInnerSegmentRect)
-    pygame.display.update()
-    FPSCLOCK.tick(FPS)
 
 def terminate():
     pygame.quit()
@@ -179,25 +379,17 @@ def showStartScreen():
             pygame.event.get() # clear event queue
             return
         pygame.display.update()
-        FPSCLOCK.tick(FPS)
+        FPSCLOCK.tick(MAX_FPS)
         degrees1 += 3 # rotate by 3 degrees each frame
         degrees2 += 7 # rotate by 7 degrees each frame
 
 def waitForStart():
-    while True:
-        try:
-            data = s.recv(1024)
-            if not data:
-                continue
-            message = json.loads(data.decode())
-            if message['type'] == 'start':
-                print("Game starting")
-                return
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Error: {e}")
-            break
+    # The window keeps answering while the host has not started the game
+    while not gameStarted:
+        poll_network(UNFOCUSED_POLL_INTERVAL)
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                terminate()
 
 
 # def showGameOverScreen():
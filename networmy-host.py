@@ -3,15 +3,38 @@
 # http://inventwithpython.com/pygame
 # Released under a "Simplified BSD" license
 
-import random, pygame, sys
-from pygame.locals import *
+import random, sys
+import atexit
+import signal
+import csv
+import os
+import secrets
 import socket
 import threading
+import asyncio
+import argparse
+import time
+from collections import deque
+from contextlib import nullcontext
 import json
 import logging
-import re
+from networmy_protocol import (encode_frame, decode, FrameReader, ProtocolError, UDP_REDUNDANCY, clock_ms, elapsed_ms,
+                               pack_state_datagram, unpack_input_datagram, NO_SNAKE, MAX_SNAKES)
+from networmy_game import Game, BoardUpdates
+from networmy_matches import Bracket, MatchManager
+from networmy_replay import Recorder
+from networmy_metrics import ClientLatency, ClientCounters, Samples, TickProfiler, Exposition, serve_metrics
+from networmy_log import setup_logging
+
+try:
+    import pygame
+    from pygame.locals import *
+    from networmy_projector import Projector
+except ImportError:
+    pygame = None  # only the projector view needs pygame, --headless runs without it
 
 FPS = 10
+PORT = 65432
 WINDOWWIDTH = 1600
 WINDOWHEIGHT = 900
 CELLSIZE = 20
@@ -55,72 +78,407 @@ RIGHT   = 3
 
 HEAD    = 0 # syntactic sugar: index of the worm's head
 
+KEYFRAME_INTERVAL = 30 # send a full board snapshot every N ticks, deltas in between
+MAX_SEND_BACKLOG = 5 # board updates a client may have waiting before they are dropped for a keyframe
+MAX_SEND_BUFFER = 64 * 1024 # bytes buffered for an asyncio client before it counts as lagging
+MAX_LAG_TICKS = 5 * FPS # consecutive ticks a client may lag behind before it is disconnected
+MAX_CATCHUP_TICKS = 5 # a simulation further behind than this skips ahead instead of bursting
+APPLES = 3 # apples on the board at any time
+PING_INTERVAL = 1.0 # seconds between pings to every client
+MAX_CONNECTIONS_PER_IP = 5
+MAX_MESSAGE_RATE = 20 # messages a second a client may send in the long run: its turns, pongs and joins
+MAX_MESSAGE_BURST = 40 # messages a client may send at once after being quiet
+FLOOD_STRIKES = 100 # dropped messages, less those forgiven, after which a client is disconnected
+PROJECTOR_FPS = 60 # how often the projector looks for a new board; a look costs next to nothing
+TICK_PHASES = ['inputs', 'simulate', 'acknowledge', 'record', 'encode', 'send', 'project', 'tick']
+
 game_started = False
 
 clients = []
-snakes = []
 client_ips = {}
-inputQueue = []
+clientSnakeIds = {} # client connection -> id of the snake it steers; spectators have none
+sessions = {} # session token from the start message -> id of the snake it steers
+game = Game(CELLWIDTH, CELLHEIGHT, appleCount=APPLES) # only the simulation thread touches it once the game runs
+pendingJoins = deque() # (client, session token) of the clients joining the running game, answered by the next tick
+broadcastLock = threading.Lock() # held while a tick is broadcast and published
+clientsLock = threading.Lock() # held while clients, client_ips or clientSnakeIds change, and while a snake id is picked
+latencyCsv = None # --latency-csv: file the per-client latency figures are appended to
+serverAddress = None # (address, port) the server listens on, --bind and --port
+statsInterval = None # --stats: seconds between the lines with the tick figures
+maxConnectionsPerIp = MAX_CONNECTIONS_PER_IP
+nextStats = 0
+tickTimes = Samples() # seconds each tick took to simulate and broadcast
+profiler = TickProfiler(TICK_PHASES) # where the ticks of the whole game went, see dump_profile()
+bytesQueued = 0 # bytes of board updates handed to the clients so far
+lastStats = None # tick, bytesQueued, CPU and wall time at the last stats line
+floodDisconnects = 0 # clients disconnected for sending too many messages
+floodLock = threading.Lock() # held while floodDisconnects is counted up
+projector = None # Projector drawing the game in its own process, unless --headless
+nextCaption = 0 # when the projector's caption with the players' latency is due again
+boardUpdates = BoardUpdates(game) # what the clients were sent of the game so far
+matches = None # MatchManager of a --tournament host, which has no game of its own
+udpChannel = None # UdpChannel of a --udp host
+recordPath = None # --record: file the game is recorded to
+recorder = None
 global socketConnection
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT, game_started, socketConnection
-
-    pygame.init()
-    FPSCLOCK = pygame.time.Clock()
-    DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
-    BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
-    pygame.display.set_caption('Wormy')
-
-    game_code = get_local_ip()
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, game_started, socketConnection, udpChannel, recordPath, latencyCsv
+    global serverAddress, statsInterval, maxConnectionsPerIp
+
+    parser = argparse.ArgumentParser(description='Host a networmy game.')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the server, the game tick and the broadcast on one asyncio event loop')
+    parser.add_argument('--headless', action='store_true',
+                        help='run without pygame or a display, the game starts once --players clients joined')
+    parser.add_argument('--players', type=int, default=2,
+                        help='number of clients to wait for before a headless game or a tournament match starts (default: 2)')
+    parser.add_argument('--tournament', type=int, metavar='MATCHES',
+                        help='run a knockout bracket starting with MATCHES parallel matches, each in its own process')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the game for networmy_replay.py; a tournament records every match next to PATH')
+    parser.add_argument('--latency-csv', metavar='PATH',
+                        help='append every client\'s latency figures to this CSV file once per ping')
+    parser.add_argument('--bind', metavar='ADDRESS',
+                        help='address to listen on (default: the address of the local network interface)')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help=f'port to listen on (default: {PORT})')
+    parser.add_argument('--max-per-ip', type=int, default=MAX_CONNECTIONS_PER_IP, metavar='CONNECTIONS',
+                        help=f'connections accepted from one address (default: {MAX_CONNECTIONS_PER_IP}), '
+                             'a load test on localhost needs more')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='least severe log messages to show (default: INFO)')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in every phase of the tick when the host exits')
+    parser.add_argument('--metrics', type=int, metavar='PORT',
+                        help='serve the host\'s counters in the Prometheus text format at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--stats', type=float, metavar='SECONDS',
+                        help='print the tick duration, bytes sent per tick and CPU use every SECONDS')
+    parser.add_argument('--udp', action='store_true',
+                        help='offer clients board updates and turns over UDP, on the same port number')
+    parser.add_argument('--udp-loss', type=float, default=0.0, metavar='FRACTION',
+                        help='drop this fraction of the UDP datagrams both ways, to test lossy networks')
+    args = parser.parse_args()
+    setup_logging(getattr(logging, args.log_level))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_profile())
+    if args.profile:
+        atexit.register(dump_profile)
+    if args.metrics is not None:
+        serve_metrics(('127.0.0.1', args.metrics), metrics_text)
+        print(f"Metrics on http://127.0.0.1:{args.metrics}/metrics")
+    if args.tournament and args.asyncio:
+        parser.error('--tournament runs on the threaded server, it cannot be combined with --asyncio')
+    if args.udp and args.asyncio:
+        parser.error('--udp runs on the threaded server, it cannot be combined with --asyncio')
+
+    if not args.headless and not args.tournament:
+        if pygame is None:
+            parser.error('pygame is not installed, use --headless to host without a display')
+        pygame.init()
+        FPSCLOCK = pygame.time.Clock()
+        DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
+        BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
+        pygame.display.set_caption('Wormy')
+
+    serverAddress = (args.bind or get_local_ip(), args.port)
+    game_code = serverAddress[0]
+    recordPath = args.record
+    latencyCsv = args.latency_csv
+    statsInterval = args.stats
+    maxConnectionsPerIp = args.max_per_ip
+    if args.udp:
+        udpChannel = UdpChannel(serverAddress, args.udp_loss)
+    if args.tournament:
+        run_tournament(game_code, args)
+        return
+    if args.asyncio:
+        asyncio.run(main_async(game_code, args))
+        return
     socketConnection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_thread = threading.Thread(target=start_server)
+    server_thread = threading.Thread(target=start_server, daemon=True)
     server_thread.start()  # Start the server in a separate thread
-    showHostPauseScreen(game_code)
+    threading.Thread(target=ping_loop, daemon=True).start()
+    if args.headless:
+        print(f"Game Code: {game_code}, waiting for {args.players} players")
+        while len(clients) < args.players:
+            time.sleep(1 / FPS)
+        startGame()
+        run_simulation()
+    else:
+        showHostPauseScreen(game_code)
+
+async def main_async(game_code, args):
+    # Accepting, reading from every client, the game tick, the broadcast and the drawing all
+    # happen on this one event loop, so the shared game state needs no locking.
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(AsyncClientProtocol, *serverAddress, reuse_address=True)
+    print(f"Server listening on {serverAddress[0]}:{serverAddress[1]}")
+    loop.create_task(ping_loop_async())
+    async with server:
+        if args.headless:
+            print(f"Game Code: {game_code}, waiting for {args.players} players")
+            while len(clients) < args.players:
+                await asyncio.sleep(1 / FPS)
+        else:
+            screen = makeHostPauseScreen(game_code)
+            while not updateHostPauseScreen(screen):
+                await asyncio.sleep(1 / FPS)
+        startGame()
+        if not args.headless:
+            open_projector()
+            loop.create_task(runGameAsync())
+        await run_simulation_async()
+
+def run_tournament(game_code, args):
+    # This process only accepts players and relays; every match simulates in a worker process
+    global matches
+    bracket = Bracket(args.tournament, args.players)
+    matches = MatchManager(bracket, wormColors, broadcast_frame, FPS, KEYFRAME_INTERVAL, APPLES, recordPath)
+    server_thread = threading.Thread(target=start_server, daemon=True)
+    server_thread.start()
+    threading.Thread(target=ping_loop, daemon=True).start()
+    firstRound = ', '.join(str(match_id) for match_id in bracket.first_round())
+    print(f"Game Code: {game_code}, join match {firstRound} ({args.players} players each)")
+    matches.finished.wait()
+    champion = matches.champion
+    print(f"Tournament won by {champion.addr if champion is not None else 'nobody'}")
+    time.sleep(1) # lets the writer threads deliver the last game over messages
 
 def runGame(conn, snake_id):
-    global snakes, clients
+    # The simulation runs on its own thread and clock and the projector draws in its own process;
+    # this thread only passes messages between them until the projector window is closed
+    open_projector()
+    threading.Thread(target=run_simulation, daemon=True).start()
+    while serve_projector(1 / FPS):
+        pass
+    terminate()
+
+async def runGameAsync():
+    while serve_projector():
+        await asyncio.sleep(1 / FPS)
+    terminate()
+
+def open_projector():
+    # The pause screen's window closes and the projector opens the game's
+    global projector
+    pygame.display.quit()
+    projector = Projector(CELLWIDTH, CELLHEIGHT, CELLSIZE, BGCOLOR, DARKGRAY,
+                          {color: getInnerColor(color) for color in wormColors}, PROJECTOR_FPS)
+    atexit.register(close_projector)
+
+def close_projector():
+    # Also at exit, or the shared board outlives the host
+    global projector
+    if projector is not None:
+        with broadcastLock: # not in the middle of publishing a tick
+            projector.close()
+            projector = None
+
+def serve_projector(timeout=0):
+    # Handles a message of the projector and keeps its caption up to date; False once the
+    # projector window is closed
+    global nextCaption
+    message = projector.receive(timeout)
+    if message is not None:
+        if message[0] == 'quit':
+            return False
+        elif message[0] == 'profile':
+            dump_profile()
+    if time.monotonic() >= nextCaption:
+        nextCaption = time.monotonic() + PING_INTERVAL
+        projector.set_caption('Wormy - ' + ', '.join(
+            f"P{clientSnakeIds.get(client)} {client.latency.describe()}" for client in clients[:]))
+    return True
+
+def run_simulation():
+    # Fixed timestep: tick n is due at start + n / FPS whatever the drawing or the network do.
+    # A simulation that fell far behind skips ahead rather than running a burst of ticks.
+    interval = 1 / FPS
+    nextTick = time.perf_counter()
+    simulate_start()
     while True:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                terminate()
-
-        # Update snake positions every frame
-        update_snake_positions()
-
-        # Send game update to all clients
-        game_update = {
-            'type': 'board_update',
-            'snakes': [
-                {
-                    'coords': [[coord['x'], coord['y']] for coord in snake['coords']],
-                    'color': snake['color'],
-                    'direction': snake['direction']
-                } for snake in snakes
-            ]
-        }
-        for client in clients:
-            try:
-                client.sendall(json.dumps(game_update).encode())
-                logging.info(f"Sent game update to client {clients.index(client)}")
-                logging.info(f"Game update: {game_update}")
-            except Exception as e:
-                logging.error(f"Error sending data to client: {e}")
-                clients.remove(client)
-                client.close()
+        nextTick += interval
+        delay = nextTick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -MAX_CATCHUP_TICKS * interval:
+            nextTick = time.perf_counter()
+        simulate_tick()
+
+async def run_simulation_async():
+    loop = asyncio.get_running_loop()
+    interval = 1 / FPS
+    nextTick = loop.time()
+    simulate_start()
+    while True:
+        nextTick += interval
+        delay = nextTick - loop.time()
+        if delay < -MAX_CATCHUP_TICKS * interval:
+            nextTick = loop.time()
+        await asyncio.sleep(max(0, delay))
+        simulate_tick()
+
+def simulate_start():
+    # Everyone gets the starting board as a keyframe before the first move
+    global recorder, lastStats, nextStats
+    lastStats = (game.tick, bytesQueued, time.process_time(), time.monotonic())
+    nextStats = lastStats[3] + (statsInterval or 0)
+    if recordPath is not None:
+        recorder = Recorder(recordPath, game, KEYFRAME_INTERVAL)
+        atexit.register(recorder.close)
+    with broadcastLock:
+        broadcast_update(encode_frame(boardUpdates.next(True)), True)
+        answer_joins()
+        if projector is not None:
+            projector.publish(game)
+
+def simulate_tick():
+    started = profiler.start()
+    turns = game.inputs.drain([snake.id for snake in game.snakes])
+    profiler.lap('inputs')
+    # Update snake positions every frame
+    update_snake_positions(turns)
+    profiler.lap('simulate')
+    acknowledge_inputs()
+    profiler.lap('acknowledge')
+    if recorder is not None:
+        recorder.record(game)
+        profiler.lap('record')
+
+    # Send game update to all clients: a full keyframe every KEYFRAME_INTERVAL ticks, deltas otherwise
+    keyframe = game.tick % KEYFRAME_INTERVAL == 0
+    data = encode_frame(boardUpdates.next(keyframe))
+    profiler.lap('encode')
+    with broadcastLock:
+        broadcast_update(data, keyframe)
+        answer_joins()
+        finished = profiler.lap('send')
+        if projector is not None:
+            # to the shared board the projector reads; the simulation never waits for the drawing
+            projector.publish(game)
+            finished = profiler.lap('project')
+    tickTimes.add(finished - started)
+    profiler.add('tick', finished - started)
+    if statsInterval is not None and time.monotonic() >= nextStats:
+        report_stats()
+
+def dump_profile():
+    # On demand: the P key on the projector, SIGUSR1, or at exit with --profile
+    print(f"Tick profile after {game.tick} ticks:\n{profiler.report()}", flush=True)
+
+def metrics_text():
+    # The page of the --metrics endpoint. Everything is read without locks from the scraping
+    # thread; a sample can be a tick old, which a dashboard does not mind.
+    page = Exposition()
+    connected = clients[:]
+    labels = {client: {'client': f"{client.addr[0]}:{client.addr[1]}", 'snake': clientSnakeIds.get(client, '')}
+              for client in connected}
+    page.add('networmy_clients', 'gauge', 'Connected clients.', len(connected))
+    page.add('networmy_snakes_alive', 'gauge', 'Snakes alive in the host\'s own game.', len(game.snakes))
+    page.add('networmy_ticks_total', 'counter', 'Ticks simulated by the host\'s own game.', game.tick)
+    page.add('networmy_flood_disconnects_total', 'counter', 'Clients disconnected for flooding the host with messages.',
+             floodDisconnects)
+    if matches is not None:
+        page.add('networmy_matches_running', 'gauge', 'Tournament matches being played.', len(matches.running))
+    page.histogram('networmy_tick_duration_seconds', 'Time to simulate and broadcast a tick.', profiler.histograms['tick'])
+    for name, attribute, help in [
+        ('networmy_client_bytes_received_total', 'bytesIn', 'Bytes received from the client.'),
+        ('networmy_client_bytes_sent_total', 'bytesOut', 'Bytes sent to the client.'),
+        ('networmy_client_messages_received_total', 'messagesIn', 'Messages received from the client.'),
+        ('networmy_client_messages_sent_total', 'messagesOut', 'Messages sent to the client.'),
+        ('networmy_client_dropped_updates_total', 'droppedUpdates',
+         'Board updates dropped for a keyframe because the client lagged.'),
+        ('networmy_client_dropped_messages_total', 'droppedMessages',
+         'Messages from the client dropped undecoded for going over its rate limit.'),
+        ('networmy_client_coalesced_turns_total', 'coalescedTurns',
+         'Repeated turns from the client dropped before reaching the game.'),
+    ]:
+        page.add(name, 'counter', help, [(labels[client], getattr(client.counters, attribute)) for client in connected])
+    page.add('networmy_client_send_backlog_bytes', 'gauge', 'Bytes waiting to be sent to the client.',
+             [(labels[client], client.backlog()) for client in connected])
+    page.add('networmy_input_queue_depth', 'gauge', 'Turns waiting to be applied, per snake.',
+             [({'snake': snake_id}, depth) for snake_id, depth in sorted(game.inputs.depths().items())])
+    return page.text()
+
+def report_stats():
+    # One line a load test can parse: tick duration percentiles over the last ticks, and the
+    # bytes queued for the clients and the CPU this process used since the previous line
+    global nextStats, lastStats
+    cpu, now = time.process_time(), time.monotonic()
+    tick, queued, lastCpu, last = lastStats
+    ticks = max(1, game.tick - tick)
+    print(f"Stats: tick {game.tick}, tick p50 {tickTimes.percentile(50) * 1000:.3f} ms, "
+          f"p99 {tickTimes.percentile(99) * 1000:.3f} ms, {(bytesQueued - queued) / ticks:.0f} bytes/tick, "
+          f"cpu {(cpu - lastCpu) / (now - last) * 100:.1f}%, {len(clients)} clients", flush=True)
+    lastStats = (game.tick, bytesQueued, cpu, now)
+    nextStats = now + statsInterval
+
+def broadcast_update(data, keyframe):
+    broadcast_frame(clients, data, keyframe, lambda: encode_frame(boardUpdates.keyframe()))
+
+def broadcast_frame(targets, data, keyframe, make_keyframe=None):
+    # The update is encoded once and queued for every client; no client is written to directly,
+    # so the tick never waits for a slow connection. Clients that dropped frames get a keyframe
+    # instead of the delta so they can resync, built by make_keyframe() or, without it, the
+    # next periodic keyframe.
+    global bytesQueued
+    resync = data if keyframe else None
+    for client in targets[:]:  # Iterate over a copy of the list to allow removal
+        if client.needsKeyframe and resync is None:
+            if make_keyframe is None:
+                continue
+            resync = make_keyframe()
+        if client.needsKeyframe:
+            client.send_update(resync, True)
+            bytesQueued += len(resync)
+        else:
+            client.send_update(data, keyframe)
+            bytesQueued += len(data)
+
+def acknowledge_inputs():
+    # Tells every client which tick applied its turns, and measures how long they waited
+    now = time.perf_counter()
+    for client, sent, receivedAt in game.inputs.take_applied():
+        client.latency.input.add(now - receivedAt)
+        client.sendall(encode_frame({'type': 'input_applied', 'tick': game.tick, 'time': sent}))
+
+def ping_loop():
+    while True:
+        send_pings()
+        time.sleep(PING_INTERVAL)
 
-        DISPLAYSURF.fill(BGCOLOR)
-        drawGrid()
-        for snake in snakes:
-            drawWorm(snake['coords'], snake['color'])
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+async def ping_loop_async():
+    while True:
+        send_pings()
+        await asyncio.sleep(PING_INTERVAL)
+
+def send_pings():
+    # The pong echoes the time, so the round trip needs no clock shared with the client
+    ping = encode_frame({'type': 'ping', 'time': clock_ms(time.monotonic())})
+    for client in clients[:]:
+        client.sendall(ping)
+    if latencyCsv is not None:
+        export_latency(latencyCsv)
+
+def export_latency(path):
+    # Appends a row per client; the columns are those of ClientLatency.summary()
+    rows = [(client, clientSnakeIds.get(client), client.latency.summary()) for client in clients[:]]
+    if not rows:
+        return
+    newFile = not os.path.exists(path)
+    with open(path, 'a', newline='') as file:
+        writer = csv.writer(file)
+        if newFile:
+            writer.writerow(['time', 'client', 'snake'] + list(rows[0][2]))
+        now = f"{time.time():.3f}"
+        for client, snake_id, summary in rows:
+            writer.writerow([now, f"{client.addr[0]}:{client.addr[1]}", snake_id] + list(summary.values()))
 
 def send_move(conn, snake_id, move):
     move_data = {'id': snake_id, 'move': move}
     conn.sendall(json.dumps(move_data).encode())
-    logging.info(f"Sent move to client {snake_id}")
-    logging.info(f"Move data: {move_data}")
+    logging.debug("Sent move %s to client %s", move_data, snake_id)
 
 def drawPressKeyMsg():
     pressKeySurf = BASICFONT.render('Press a key to play.', True, DARKGRAY)
@@ -168,64 +526,123 @@ def showStartScreen():
         degrees2 += 7  # rotate by 7 degrees each frame
 
 def showHostPauseScreen(game_code):
-    global clients, game_started
+    screen = makeHostPauseScreen(game_code)
+    while not updateHostPauseScreen(screen):
+        FPSCLOCK.tick(FPS)
+    startGame()
+    runGame(clients[0], 0)  # Start the game and pass the first client connection and snake_id
+
+def makeHostPauseScreen(game_code):
     titleFont = pygame.font.Font('freesansbold.ttf', 50)
     titleSurf = titleFont.render('Game Code: ' + game_code, True, WHITE)
     titleRect = titleSurf.get_rect()
     titleRect.center = (WINDOWWIDTH / 2, WINDOWHEIGHT / 4)
 
     startButton = pygame.Rect(WINDOWWIDTH / 2 - 75, WINDOWHEIGHT / 2, 150, 50)
+    startText = BASICFONT.render('Start', True, WHITE)
+    startTextRect = startText.get_rect(center=startButton.center)
+
+    noClientSurf = BASICFONT.render('At least one client is required to start the game.', True, RED)
+    noClientRect = noClientSurf.get_rect(center=(WINDOWWIDTH / 2, WINDOWHEIGHT / 2 + 100))
+    return {
+        'blits': [(titleSurf, titleRect), (startText, startTextRect), (noClientSurf, noClientRect)],
+        'startButton': startButton
+    }
+
+def updateHostPauseScreen(screen):
+    # Draws one frame of the pause screen, returns True once the host clicked Start
+    DISPLAYSURF.fill(BGCOLOR)
+    pygame.draw.rect(DISPLAYSURF, GREEN, screen['startButton'])
+    DISPLAYSURF.blits(screen['blits'])
+    for row, client in enumerate(clients[:]):
+        text = f"Player {clientSnakeIds.get(client)} ({client.addr[0]}): {client.latency.describe()}"
+        DISPLAYSURF.blit(BASICFONT.render(text, True, WHITE), (WINDOWWIDTH / 2 - 300, WINDOWHEIGHT / 2 + 150 + row * 24))
+
+    for event in pygame.event.get():
+        if event.type == QUIT:
+            terminate()
+        elif event.type == MOUSEBUTTONUP:
+            mouseX, mouseY = event.pos
+            if screen['startButton'].collidepoint((mouseX, mouseY)):
+                if len(clients) > 0:  # Check if at least one client is connected
+                    return True
+                else:
+                    print("No clients connected")
 
-    while True:
-        DISPLAYSURF.fill(BGCOLOR)
-        DISPLAYSURF.blit(titleSurf, titleRect)
-
-        pygame.draw.rect(DISPLAYSURF, GREEN, startButton)
-        startText = BASICFONT.render('Start', True, WHITE)
-        startTextRect = startText.get_rect(center=startButton.center)
-        DISPLAYSURF.blit(startText, startTextRect)
-
-        noClientSurf = BASICFONT.render('At least one client is required to start the game.', True, RED)
-        noClientRect = noClientSurf.get_rect(center=(WINDOWWIDTH / 2, WINDOWHEIGHT / 2 + 100))
-        DISPLAYSURF.blit(noClientSurf, noClientRect)
-
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                terminate()
-            elif event.type == MOUSEBUTTONUP:
-                mouseX, mouseY = event.pos
-                if startButton.collidepoint((mouseX, mouseY)):
-                    if len(clients) > 0:  # Check if at least one client is connected
-                        # Define start positions for each side of the screen
-                        start_positions = [
-                            [(5, 5), (5, 6), (5, 7)],  # Top-left
-                            [(5, 20), (5, 21), (5, 22)],  # middle-left
-                            [(5, 40), (5, 21), (5, 22)],  # Bottom-left
-                        ]
-
-                        # Send start message to all clients
-                        for i, client in enumerate(clients):
-                            print(f"Sending start message to client {i}")
-                            snake_coords = [{'x': x, 'y': y} for x, y in start_positions[i % len(start_positions)]]
-                            snake_color = wormColors[i % len(wormColors)]
-                            start_message = json.dumps({
-                                "type": "start",
-                                "coords": {
-                                    "coords": [[coord['x'], coord['y']] for coord in snake_coords],
-                                    "color": snake_color
-                                }
-                            }).encode()
-                            client.sendall(start_message)
-                            print(f"Sent start message to client {i}")
-                            snakes.append({'id': i, 'coords': snake_coords, 'direction': RIGHT, 'color': snake_color})
-                        game_started = True  # Set game_started to True for the host
-                        runGame(clients[0], 0)  # Start the game and pass the first client connection and snake_id
-                        return
-                    else:
-                        print("No clients connected")
-
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+    pygame.display.update()
+    return False
+
+def startGame():
+    global game_started
+    with clientsLock: # no connection gets a snake id while the seats are handed out
+        # Send start message to all clients
+        for i, client in enumerate(clients):
+            snake_id = clientSnakeIds.get(client)
+            print(f"Sending start message to client {i}")
+            spawn = game.spawn_position() if snake_id is not None else None
+            if spawn is None:
+                if snake_id is not None:
+                    logging.warning("No room left on the board for client %d", i)
+                    del clientSnakeIds[client]
+                client.sendall(encode_frame({'type': 'start', 'id': NO_SNAKE, 'coords': [], 'color': BGCOLOR, 'token': 0}))
+                continue
+            snake_coords, snake_direction = spawn
+            snake_color = wormColors[snake_id % len(wormColors)]
+            start_message = encode_frame({
+                'type': 'start',
+                'id': snake_id,
+                'coords': snake_coords,
+                'color': snake_color,
+                'token': new_session(snake_id)
+            })
+            client.sendall(start_message)
+            print(f"Sent start message to client {i}")
+            game.add_snake(game.new_snake(snake_id, snake_coords, snake_direction, snake_color))
+        game.place_apples()
+        game_started = True  # Set game_started to True for the host
+
+def new_session(snake_id):
+    token = secrets.randbits(32)
+    while token == 0 or token in sessions:
+        token = secrets.randbits(32)
+    sessions[token] = snake_id
+    return token
+
+def join_game(client, token):
+    # A client joining the running game gets the board from the simulation thread, right after
+    # the next tick went out, so the next delta follows on from it. With the session token of
+    # its start message a reconnecting player steers its snake again; anyone else watches.
+    if not game_started:
+        return  # startGame() will send the start message
+    pendingJoins.append((client, token))
+
+def answer_joins():
+    # On the simulation thread, under broadcastLock: the start message and a keyframe of the
+    # board for every client that joined since the last tick, one keyframe encoded for all
+    data = None
+    while pendingJoins:
+        client, token = pendingJoins.popleft()
+        snake_id = sessions.get(token)
+        if snake_id is not None:
+            for other, other_id in list(clientSnakeIds.items()):
+                if other_id == snake_id and other is not client:
+                    other.close()  # the dropped connection, if the host has not noticed yet
+            with clientsLock:
+                clientSnakeIds[client] = snake_id
+            logging.info("Client %s is back on snake %d", client.addr, snake_id)
+        else:
+            token = 0
+        snake = next((snake for snake in game.snakes if snake.id == clientSnakeIds.get(client)), None)
+        client.sendall(encode_frame({
+            'type': 'start',
+            'id': clientSnakeIds.get(client, NO_SNAKE),
+            'coords': game.coords(snake) if snake is not None else [],
+            'color': snake.color if snake is not None else BGCOLOR,
+            'token': token
+        }))
+        if data is None:
+            data = encode_frame(boardUpdates.keyframe())
+        client.send_update(data, True)
 
 def get_local_ip():
     tempSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -239,141 +656,454 @@ def get_local_ip():
     return ip
 
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-def handle_client(conn, addr):
-    global clients, snakes, client_ips, inputQueue
+def register_client(conn, addr):
+    # Returns the id of the snake the new connection steers, NO_SNAKE for a spectator, or None
+    # when it is refused
     ip = addr[0]
-    logging.info(f"Connected by {addr}")
+    logging.info("Connected by %s", addr)
+
+    with clientsLock: # connections arriving at once on their own threads must not share an id
+        if ip in client_ips:
+            client_ips[ip] += 1
+        else:
+            client_ips[ip] = 1
+
+        if client_ips[ip] > maxConnectionsPerIp:
+            logging.warning("Too many connections from %s. Closing connection.", ip)
+            release_ip(ip)
+            return None
+
+        clients.append(conn)
+        snake_id = free_snake_id() if not game_started else None
+        if snake_id is None:
+            return NO_SNAKE # the game is on or every id is taken: it can watch, or rejoin with a session token
+        clientSnakeIds[conn] = snake_id
+        return snake_id
+
+def free_snake_id():
+    # The lowest id no connection and no session holds, so ids stay within the wire format's
+    # uint8 however many clients come and go; None when all MAX_SNAKES are taken. Called with
+    # clientsLock held.
+    taken = set(clientSnakeIds.values())
+    taken.update(sessions.values())
+    return next((snake_id for snake_id in range(MAX_SNAKES) if snake_id not in taken), None)
+
+def unregister_client(conn, addr):
+    with clientsLock:
+        if conn in clients:  # a failed send in ClientConnection.write_loop only closes the connection, it leaves here
+            clients.remove(conn)
+        clientSnakeIds.pop(conn, None)
+        release_ip(addr[0])
+    if matches is not None:
+        matches.leave(conn)
+    if udpChannel is not None:
+        udpChannel.unregister(conn)
+    logging.info("Disconnected by %s", addr)
+
+def release_ip(ip):
+    client_ips[ip] -= 1
+    if client_ips[ip] == 0:
+        del client_ips[ip]
+
+def admit_message(client):
+    # Called for every message before it is decoded, so a client hammering the socket costs
+    # little more than the reads. False drops the message; a flooding client is disconnected.
+    global floodDisconnects
+    with client.ingress:
+        client.counters.messagesIn += 1
+        if client.limiter.take():
+            return True
+        client.counters.droppedMessages += 1
+        flooding = client.limiter.flooding()
+        if flooding:
+            with floodLock: # the reading threads of other clients count theirs too
+                floodDisconnects += 1
+    if flooding:
+        logging.warning("Disconnecting %s, it keeps sending more than %d messages a second", client.addr, MAX_MESSAGE_RATE)
+        client.close()
+    return False
+
+def handle_message(client, msgData):
+    try:
+        msgData = decode(msgData)
+        if msgData["type"] == 'join':
+            # match 0 is the host's own game, which every client is in already
+            if matches is not None:
+                if not matches.join(client, msgData["match"], msgData["token"]):
+                    logging.warning("Client %s cannot join match %d", client.addr, msgData['match'])
+            else:
+                join_game(client, msgData["token"])
+        elif msgData["type"] == 'udp':
+            # a client asking for the UDP channel gets the token for its datagrams; without
+            # --udp there is no answer and it stays on TCP
+            if udpChannel is not None and isinstance(client, ClientConnection):
+                client.sendall(encode_frame({'type': 'udp', 'token': udpChannel.register(client)}))
+        elif msgData["type"] == 'resync':
+            # a UDP client that lost more updates than a datagram repeats: a keyframe on the next tick
+            if matches is not None:
+                matches.resync(client)
+            else:
+                client.needsKeyframe = True
+        elif msgData["type"] == 'direction':
+            direction, now = int(msgData["direction"]), time.perf_counter()
+            if direction == client.lastTurn[0] and now - client.lastTurn[1] < 1 / FPS:
+                # the same turn again within a tick, e.g. a held key: it could not change anything
+                client.counters.coalescedTurns += 1
+                return
+            client.lastTurn = (direction, now)
+            steer(client, clientSnakeIds.get(client), direction, (client, msgData["sent"], now))
+        elif msgData["type"] == 'pong':
+            client.latency.add_rtt(elapsed_ms(msgData["time"], clock_ms(time.monotonic())) / 1000)
+    # exception with message decoding
+    except Exception as e:
+        logging.error("Error: %s", e)
+
+def steer(client, snake_id, direction, stamp=None):
+    if direction in [UP, DOWN, LEFT, RIGHT]:
+        if matches is not None:
+            matches.turn(client, direction)
+        # add direction to the snake's input queue
+        elif game.inputs.enqueue(snake_id, direction, stamp):
+            logging.debug("Added direction %d to the input queue of snake %d", direction, snake_id)
+
+class IngressLimiter:
+    # A token bucket over the messages of one client. Every dropped message is a strike against
+    # the client; strikes are forgiven at half the message rate, so a client only counts as
+    # flooding once it keeps sending well past its limit, not after one burst.
+
+    def __init__(self, rate=MAX_MESSAGE_RATE, burst=MAX_MESSAGE_BURST, strikes=FLOOD_STRIKES):
+        self.rate = rate
+        self.burst = burst
+        self.maxStrikes = strikes
+        self.tokens = burst
+        self.strikes = 0.0
+        self.last = time.monotonic()
+        self.flooded = False
+
+    def take(self):
+        # True when the client may send another message
+        now = time.monotonic()
+        elapsed = now - self.last
+        self.last = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.strikes = max(0.0, self.strikes - elapsed * self.rate / 2)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.strikes += 1
+        return False
+
+    def flooding(self):
+        # True once, when the strikes run out
+        if self.flooded or self.strikes <= self.maxStrikes:
+            return False
+        self.flooded = True
+        return True
+
+class ClientConnection:
+    # A client in the threaded server. Frames are queued and a writer thread per client sends
+    # them, so a client with a full TCP window only ever blocks its own writer.
+    #
+    # Board updates pile up while the client lags. Past MAX_SEND_BACKLOG they are all dropped
+    # in favour of a keyframe on the next tick, and a client that keeps lagging for
+    # MAX_LAG_TICKS is disconnected.
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.pending = deque() # (frame, is board update, time queued) waiting for the writer
+        self.ready = threading.Condition()
+        self.needsKeyframe = False
+        self.lagTicks = 0
+        self.closed = False
+        self.latency = ClientLatency()
+        self.counters = ClientCounters()
+        self.limiter = IngressLimiter()
+        self.ingress = threading.Lock() # around the limiter and the counters in: the reading thread and the UDP channel both take messages
+        self.lastTurn = (None, 0.0) # direction and time of the last turn taken from the client
+        self.udpAddr = None # where board updates go instead once the client's UDP channel is up
+        self.udpToken = None
+        self.udpSequence = 0
+        self.udpRecent = deque(maxlen=UDP_REDUNDANCY) # update frames repeated in the next datagram
+        self.udpInputSequence = 0 # newest input taken from the client's datagrams
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def sendall(self, data):
+        # Control messages are always delivered
+        with self.ready:
+            self.pending.append((data, False, time.perf_counter()))
+            self.ready.notify()
+
+    def send_update(self, data, keyframe):
+        if self.udpAddr is not None:
+            udpChannel.send_update(self, data, keyframe)
+            return
+        with self.ready:
+            if self.closed:
+                return
+            backlog = sum(1 for frame, isUpdate, queuedAt in self.pending if isUpdate)
+            if backlog > 0:
+                self.lagTicks += 1 # the writer has not caught up since the previous tick
+            if self.lagTicks > MAX_LAG_TICKS:
+                logging.warning("Client %s keeps lagging behind. Closing connection.", self.addr)
+                self.close_locked()
+                return
+            if keyframe or backlog >= MAX_SEND_BACKLOG:
+                # the updates still waiting are stale now, only control messages are kept
+                self.pending = deque(item for item in self.pending if not item[1])
+                self.counters.droppedUpdates += backlog
+                self.needsKeyframe = not keyframe
+                if not keyframe:
+                    self.counters.droppedUpdates += 1
+                    return
+            self.pending.append((data, True, time.perf_counter()))
+            self.ready.notify()
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.pending and not self.closed:
+                    self.lagTicks = 0 # caught up
+                    self.ready.wait()
+                if self.closed:
+                    return
+                data, isUpdate, queuedAt = self.pending.popleft()
+            try:
+                self.conn.sendall(data)
+                self.latency.queueing.add(time.perf_counter() - queuedAt)
+                with self.ready: # the tick counts the client's datagrams
+                    self.counters.bytesOut += len(data)
+                    self.counters.messagesOut += 1
+            except Exception as e:
+                logging.error("Error sending data to client: %s", e)
+                self.close()
+                return
 
-    if ip in client_ips:
-        client_ips[ip] += 1
-    else:
-        client_ips[ip] = 1
+    def backlog(self):
+        with self.ready:
+            return sum(len(item[0]) for item in self.pending)
+
+    def close(self):
+        with self.ready:
+            self.close_locked()
 
-    if client_ips[ip] > 5:  # Limit to 5 connections per IP
-        logging.warning(f"Too many connections from {ip}. Closing connection.")
+    def close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.notify()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR) # wakes up the reading thread
+        except OSError:
+            pass
+
+class UdpChannel:
+    # The optional UDP state channel (--udp). A lost datagram delays nothing behind it, unlike a
+    # lost TCP segment. Every state datagram carries a sequence number and the client's last
+    # UDP_REDUNDANCY update frames, and every input datagram the client's last inputs, so a
+    # few lost datagrams are made up by the next one; stale and duplicate ones are skipped.
+    #
+    # A client asks for the channel over TCP and gets a random token back. The first datagram
+    # carrying that token tells the host where to send the client's board updates from then
+    # on. Start, game over and every other control message stay on TCP.
+
+    def __init__(self, address, loss=0.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.loss = loss # fraction of datagrams dropped on purpose, both ways
+        self.lock = threading.Lock()
+        self.tokens = {} # token -> ClientConnection
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        print(f"UDP channel on {address[0]}:{address[1]}")
+
+    def register(self, client):
+        with self.lock:
+            if client.udpToken is None:
+                token = secrets.randbits(32)
+                while token in self.tokens:
+                    token = secrets.randbits(32)
+                client.udpToken = token
+                self.tokens[token] = client
+            return client.udpToken
+
+    def unregister(self, client):
+        with self.lock:
+            self.tokens.pop(client.udpToken, None)
+
+    def dropped(self):
+        return self.loss > 0 and random.random() < self.loss
+
+    def send_update(self, client, data, keyframe):
+        # Sent straight from the tick: a datagram never waits for the client
+        if keyframe:
+            client.udpRecent.clear() # nothing before a keyframe is needed any more
+            client.needsKeyframe = False # e.g. set by a rejoin or by lagging on TCP before
+        client.udpRecent.append(data)
+        client.udpSequence += 1
+        if self.dropped():
+            return
+        try:
+            sent = self.sock.sendto(pack_state_datagram(client.udpSequence, client.udpRecent), client.udpAddr)
+        except OSError as e:
+            logging.error("Error sending datagram to client: %s", e)
+            return
+        with client.ready: # the client's writer thread counts its TCP frames
+            client.counters.bytesOut += sent
+            client.counters.messagesOut += 1
+
+    def receive_loop(self):
+        while True:
+            data, addr = self.sock.recvfrom(2048)
+            if self.dropped():
+                continue
+            try:
+                token, sequence, directions = unpack_input_datagram(data)
+            except ProtocolError:
+                continue
+            with self.lock:
+                client = self.tokens.get(token)
+            if client is None:
+                continue
+            with client.ingress:
+                client.counters.bytesIn += len(data)
+            if not admit_message(client):
+                continue
+            client.udpAddr = addr
+            # inputs the client sent before are repeated; only the newer ones count
+            first = sequence - len(directions) + 1
+            for inputSequence, direction in enumerate(directions, first):
+                if inputSequence > client.udpInputSequence:
+                    client.udpInputSequence = inputSequence
+                    steer(client, clientSnakeIds.get(client), direction)
+
+def handle_client(conn, addr):
+    client = ClientConnection(conn, addr)
+    snake_id = register_client(client, addr)
+    if snake_id is None:
+        client.close()
         conn.close()
         return
 
-    clients.append(conn)
-    snake_id = len(snakes)
-    snake_color = wormColors[snake_id % len(wormColors)]
     try:
         with conn:
-            buffer = ""
+            reader = FrameReader()
             while True:
-                data = conn.recv(1024).decode()
-                if not data:
+                count = reader.fill(conn)
+                if count == 0:
                     break
+                with client.ingress:
+                    client.counters.bytesIn += count
 
-                buffer += data
-                json_objects = re.findall(r'\{.*?\}(?=\{)|\{.*?\}$', buffer)
-                buffer = re.sub(r'\{.*?\}(?=\{)|\{.*?\}$', '', buffer)
-                logging.info(f"Received JSON objects: {json_objects}")
-                # log how many json objects were received
-                logging.info(f"Received {len(json_objects)} JSON objects")
-
-                for msgData in json_objects:
-                    try:
-                        msgData = json.loads(msgData)
-                        if msgData["type"] == 'direction':
-                            direction = int(msgData["direction"])
-                            if direction in [UP, DOWN, LEFT, RIGHT]:
-                                # add direction to input queue
-                                inputQueue.append((snake_id, direction))
-                                logging.info(f"Added direction to input queue: {direction}")
-                    # exception with JSON parsing
-                    except Exception as e:
-                        logging.error(f"Error: {e}")
+                for msgData in reader.frames():
+                    if admit_message(client):
+                        handle_message(client, msgData)
     # exception with connection
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.error("Error: %s", e)
     finally:
-        clients.remove(conn)
-        client_ips[ip] -= 1
-        if client_ips[ip] == 0:
-            del client_ips[ip]
-        logging.info(f"Disconnected by {addr}")
+        client.close()
+        unregister_client(client, addr)
+
+class AsyncClientProtocol(asyncio.BufferedProtocol):
+    # One per connection in --asyncio mode. Incoming bytes land directly in the connection's
+    # FrameReader buffer and every client writes through its own transport.
+
+    #
+    # Writes never block: the transport buffers them. Once more than MAX_SEND_BUFFER bytes are
+    # waiting the transport pauses writing, board updates are dropped from then on and the client
+    # gets a keyframe as soon as it catches up. A client paused for MAX_LAG_TICKS is disconnected.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.reader = FrameReader()
+        self.needsKeyframe = False
+        self.lagTicks = 0
+        self.paused = False
+        self.latency = ClientLatency() # no queueing figures: the transport buffers the writes
+        self.counters = ClientCounters()
+        self.limiter = IngressLimiter()
+        self.ingress = nullcontext() # only the event loop takes messages from the client
+        self.lastTurn = (None, 0.0)
+        transport.set_write_buffer_limits(high=MAX_SEND_BUFFER)
+        self.snake_id = register_client(self, self.addr)
+        if self.snake_id is None:
+            transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.reader.writable()
+
+    def buffer_updated(self, nbytes):
+        self.reader.commit(nbytes)
+        self.counters.bytesIn += nbytes
+        for msgData in self.reader.frames():
+            if admit_message(self):
+                handle_message(self, msgData)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logging.error("Error: %s", exc)
+        if self.snake_id is not None:
+            unregister_client(self, self.addr)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.lagTicks = 0
+
+    def sendall(self, data):
+        self.transport.write(data)
+        self.counters.bytesOut += len(data)
+        self.counters.messagesOut += 1
+
+    def send_update(self, data, keyframe):
+        if self.paused:
+            self.needsKeyframe = True
+            self.counters.droppedUpdates += 1
+            self.lagTicks += 1
+            if self.lagTicks > MAX_LAG_TICKS:
+                logging.warning("Client %s keeps lagging behind. Closing connection.", self.addr)
+                self.transport.abort()
+            return
+        if keyframe:
+            self.needsKeyframe = False
+        self.sendall(data)
+
+    def backlog(self):
+        return self.transport.get_write_buffer_size()
+
+    def close(self):
+        self.transport.close()
 
 def start_server():
-    HOST = get_local_ip()
-    PORT = 65432
+    HOST, port = serverAddress
     print(f"Server IP: {HOST}")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as serverSocket:
-        serverSocket.bind((HOST, PORT))
+        # a restarted host can listen again while connections of the last run linger in TIME_WAIT
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        serverSocket.bind((HOST, port))
         serverSocket.listen()
-        print(f"Server listening on {HOST}:{PORT}")
+        print(f"Server listening on {HOST}:{port}")
         while True:
             conn, addr = serverSocket.accept()
             client_thread = threading.Thread(target=handle_client, args=(conn, addr))
             client_thread.start()
 
-def direction_to_constant(direction):
-    if direction == 0:
-        return UP
-    elif direction == 1:
-        return DOWN
-    elif direction == 2:
-        return LEFT
-    elif direction == 3:
-        return RIGHT
-
-
-def update_snake_positions():
-    global snakes, inputQueue
-    for snake in snakes[:]:  # Iterate over a copy of the list to allow removal
-        # Check for input queue
-        if len(inputQueue) > 0:
-            # Check if the input is for this snake
-            snake_id, direction = inputQueue.pop(0)
-            if snake_id == snake['id']:
-                # check if the move is valid
-                if snake['direction'] == UP and direction == DOWN:
-                    continue
-                elif snake['direction'] == DOWN and direction == UP:
-                    continue
-                elif snake['direction'] == LEFT and direction == RIGHT:
-                    continue
-                elif snake['direction'] == RIGHT and direction == LEFT:
-                    continue
-                snake['direction'] = direction_to_constant(direction)
-
-
-        newHead = calculate_new_position(snake['coords'][HEAD], snake['direction'])
-
-        # Check for collision with boundaries
-        if newHead['x'] < 0 or newHead['x'] >= CELLWIDTH or newHead['y'] < 0 or newHead['y'] >= CELLHEIGHT:
-            print(f"Snake {snake['id']} collided with the boundary and will be removed.")
-            snakes.remove(snake)
-            continue
-
-        # Check for collision with itself
-        if newHead in snake['coords']:
-            print(f"Snake {snake['id']} collided with itself and will be removed.")
-            snakes.remove(snake)
-            continue
-
-        snake['coords'].insert(0, newHead)
-        snake['coords'].pop()
-
-def calculate_new_position(head, direction):
-    if direction == UP:
-        return {'x': head['x'], 'y': head['y'] - 1}
-    elif direction == DOWN:
-        return {'x': head['x'], 'y': head['y'] + 1}
-    elif direction == LEFT:
-        return {'x': head['x'] - 1, 'y': head['y']}
-    elif direction == RIGHT:
-        return {'x': head['x'] + 1, 'y': head['y']}
+def update_snake_positions(turns=None):
+    for snake, reason in game.step(turns):
+        print(f"Snake {snake.id} collided with {reason} and will be removed.")
 
 def terminate():
+    close_projector()
     pygame.quit()
     sys.exit()
 
 def getRandomLocation():
-    return {'x': random.randint(0, CELLWIDTH - 1), 'y': random.randint(0, CELLHEIGHT - 1)}
+    # from the game's seeded generator, so a recording replays the same spawns
+    x, y = game.random_location()
+    return {'x': x, 'y': y}
 
 def showGameOverScreen():
     gameOverFont = pygame.font.Font('freesansbold.ttf', 150)
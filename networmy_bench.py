@@ -0,0 +1,437 @@
+# Networmy benchmarks
+# A load test and micro-benchmarks of the hot paths, so a change that slows the host down shows
+# up as a number instead of as a stuttering game night.
+#
+# The load test starts networmy-host.py --headless on localhost and connects bot clients to
+# it that speak the real protocol: they join, answer pings, keep a board in sync and steer
+# their snake, randomly or along a fixed square. The host's --stats lines give the tick
+# duration, the bytes it queued per tick and its CPU use; the bots time their own turns until
+# the host applied them and until the board update of that tick arrived. With --flood some
+# clients join the running game and send turns as fast as the socket takes them, which the
+# host should drop and then disconnect without the tick noticing. Where there is SIGUSR1 the
+# host is asked for its tick profile before it is stopped. Just before that the
+# host's --metrics endpoint is scraped over loopback and every line of it is checked against
+# the Prometheus text format.
+#
+# The micro-benchmarks time a tick of the game, building board updates, encoding and decoding
+# them, splitting a stream into frames and applying updates to a client's board.
+#
+#   python networmy_bench.py                      load test with 8 random bots for 10 seconds
+#   python networmy_bench.py --bots 32 --asyncio  load test of the asyncio server
+#   python networmy_bench.py --flood 4            with 4 flooding clients besides the bots
+#   python networmy_bench.py --micro              micro-benchmarks only
+#   python networmy_bench.py --check-metrics      serves a sample page with the metrics endpoint and checks it
+
+import argparse
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import urllib.error
+import urllib.request
+from collections import deque
+
+from networmy_game import UP, DOWN, LEFT, RIGHT, Game, BoardUpdates
+from networmy_protocol import (encode_frame, encode, decode, frame, FrameReader, new_board, apply_board_update,
+                               clock_ms, elapsed_ms)
+from networmy_metrics import Samples, Histogram, Exposition, serve_metrics
+
+HOST_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'networmy-host.py')
+SQUARE = [RIGHT, DOWN, LEFT, UP] # the scripted bots' turns, one every SQUARE_SIDE ticks
+SQUARE_SIDE = 4
+METRICS_LINE = re.compile(r'# (HELP|TYPE) \w+ .+|[a-zA-Z_:][\w:]*(\{(\w+="([^"\\\n]|\\.)*",?)*\})? \S+')
+STATS_LINE = re.compile(r'Stats: tick (\d+), tick p50 ([\d.]+) ms, p99 ([\d.]+) ms, (\d+) bytes/tick, cpu ([\d.]+)%')
+
+
+class Bot:
+    # One client on its own socket and thread. Its latency samples are in seconds.
+
+    def __init__(self, address, strategy, turnChance=0.2, seed=None):
+        self.strategy = strategy
+        self.turnChance = turnChance
+        self.random = random.Random(seed)
+        self.sock = socket.create_connection(address)
+        self.sock.sendall(encode_frame({'type': 'join', 'match': 0, 'token': 0}))
+        self.reader = FrameReader()
+        self.board = new_board()
+        self.started = False
+        self.applied = [] # (tick, time sent) of turns the host applied but the bots did not see yet
+        self.inputLatency = Samples(4096)  # until the host confirmed the tick that applied the turn
+        self.updateLatency = Samples(4096) # until the board update of that tick arrived
+        self.received = 0 # bytes
+        self.updates = 0
+        self.missed = 0   # deltas that did not fit the board
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                count = self.reader.fill(self.sock)
+                if count == 0:
+                    return
+                self.received += count
+                for payload in self.reader.frames():
+                    self.handle(decode(payload))
+        except OSError:
+            pass # closed by stop()
+
+    def handle(self, message):
+        now = clock_ms(time.monotonic())
+        if message['type'] == 'ping':
+            self.sock.sendall(encode_frame({'type': 'pong', 'time': message['time']}))
+        elif message['type'] == 'start':
+            self.started = True
+        elif message['type'] == 'input_applied':
+            self.inputLatency.add(elapsed_ms(message['time'], now) / 1000)
+            self.applied.append((message['tick'], message['time']))
+        elif message['type'] == 'board_update':
+            self.updates += 1
+            if not apply_board_update(self.board, message):
+                self.missed += 1
+            while self.applied and self.applied[0][0] <= message['tick']:
+                self.updateLatency.add(elapsed_ms(self.applied.pop(0)[1], now) / 1000)
+            if self.started:
+                self.steer(message['tick'])
+
+    def steer(self, tick):
+        if self.strategy == 'scripted':
+            if tick % SQUARE_SIDE:
+                return
+            direction = SQUARE[tick // SQUARE_SIDE % len(SQUARE)]
+        elif self.random.random() < self.turnChance:
+            direction = self.random.choice((UP, DOWN, LEFT, RIGHT))
+        else:
+            return
+        self.sock.sendall(encode_frame({'type': 'direction', 'direction': direction, 'sent': clock_ms(time.monotonic())}))
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.thread.join(1)
+
+
+class Flooder:
+    # A client sending turns as fast as it can until the host hangs up. It reads everything the
+    # host sends, so it is disconnected for flooding and not for lagging.
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.sendall(encode_frame({'type': 'join', 'match': 0, 'token': 0}))
+        self.sent = 0 # messages
+        self.disconnected = threading.Event()
+        threading.Thread(target=self.drain, daemon=True).start()
+        threading.Thread(target=self.flood, daemon=True).start()
+
+    def drain(self):
+        try:
+            while self.sock.recv(65536):
+                pass
+        except OSError:
+            pass
+        self.disconnected.set()
+
+    def flood(self):
+        turns = b''.join(encode_frame({'type': 'direction', 'direction': direction, 'sent': 0})
+                         for direction in SQUARE * 25)
+        try:
+            while not self.disconnected.is_set():
+                self.sock.sendall(turns)
+                self.sent += 100
+        except OSError:
+            self.disconnected.set()
+
+    def stop(self):
+        self.sock.close()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def scrape_metrics(port):
+    # {sample name with its labels: value}; raises ValueError on a line that is not in the text format
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        text = response.read().decode()
+    samples = {}
+    for line in text.splitlines():
+        if not METRICS_LINE.fullmatch(line):
+            raise ValueError(f'bad metrics line: {line!r}')
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+def load_test(bots=8, seconds=10, strategy='random', useAsyncio=False, statsInterval=1.0, flood=0):
+    # Returns the host's stats lines as tuples (tick, p50 ms, p99 ms, bytes per tick, cpu %),
+    # the bots, the lines of the host's tick profile and its metrics scraped at the end. The
+    # flooders join a second into the game.
+    port, metricsPort = free_port(), free_port()
+    command = [sys.executable, '-u', HOST_SCRIPT, '--headless', '--players', str(bots),
+               '--bind', '127.0.0.1', '--port', str(port), '--stats', str(statsInterval), '--max-per-ip', str(bots + flood),
+               '--metrics', str(metricsPort)]
+    if useAsyncio:
+        command.append('--asyncio')
+    host = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    lines = []
+    profile = []
+    listening = threading.Event()
+    def read_host():
+        for line in host.stdout:
+            if 'listening' in line:
+                listening.set()
+            match = STATS_LINE.search(line)
+            if match:
+                lines.append((int(match[1]), float(match[2]), float(match[3]), int(match[4]), float(match[5])))
+            elif profile or line.startswith('Tick profile'):
+                profile.append(line.rstrip())
+    reader = threading.Thread(target=read_host, daemon=True)
+    reader.start()
+    players = []
+    flooders = []
+    metrics = {}
+    try:
+        if not listening.wait(10):
+            raise RuntimeError('the host did not start listening')
+        players = [Bot(('127.0.0.1', port), strategy, seed=number) for number in range(bots)]
+        if flood:
+            time.sleep(1)
+            flooders = [Flooder(('127.0.0.1', port)) for _ in range(flood)]
+            time.sleep(seconds - 1)
+        else:
+            time.sleep(seconds)
+        metrics = scrape_metrics(metricsPort)
+    finally:
+        if hasattr(signal, 'SIGUSR1') and host.poll() is None:
+            host.send_signal(signal.SIGUSR1)
+            time.sleep(0.5)
+        for bot in players:
+            bot.stop()
+        for flooder in flooders:
+            flooder.stop()
+        host.terminate()
+        host.wait()
+        reader.join(1)
+    return lines, players, profile, metrics
+
+def report_metrics(metrics):
+    def total(prefix):
+        return sum(value for name, value in metrics.items() if name.startswith(prefix + '{'))
+    print(f"  metrics            {metrics['networmy_clients']:.0f} clients, {metrics['networmy_ticks_total']:.0f} ticks,"
+          f" {total('networmy_client_messages_received_total'):.0f} messages in,"
+          f" {total('networmy_client_messages_sent_total'):.0f} out,"
+          f" {total('networmy_client_dropped_updates_total'):.0f} updates dropped")
+    # the counters of disconnected clients are gone, those of the flooders among them
+    print(f"  ingress            {metrics['networmy_flood_disconnects_total']:.0f} flooders disconnected; clients left:"
+          f" {total('networmy_client_dropped_messages_total'):.0f} messages over the limit dropped,"
+          f" {total('networmy_client_coalesced_turns_total'):.0f} repeated turns coalesced")
+
+def report_load_test(lines, bots, seconds):
+    if not lines:
+        print("no stats from the host, did the game start?")
+        return
+    ticks = lines[-1][0]
+    # the first line covers the start, with every client getting its keyframe
+    steady = lines[1:] or lines
+    cpu = sum(line[4] for line in steady) / len(steady)
+    bytesPerTick = sum(line[3] for line in steady) / len(steady)
+    inputs, updates = Samples(1 << 20), Samples(1 << 20)
+    for bot in bots:
+        for value in bot.inputLatency.values:
+            inputs.add(value)
+        for value in bot.updateLatency.values:
+            updates.add(value)
+    received = sum(bot.received for bot in bots)
+    print(f"{len(bots)} bots, {ticks} ticks in {seconds} s")
+    print(f"  tick duration      p50 {lines[-1][1]:.3f} ms, p99 {lines[-1][2]:.3f} ms")
+    print(f"  sent per tick      {bytesPerTick:.0f} bytes ({bytesPerTick / max(len(bots), 1):.0f} per client)")
+    print(f"  host CPU           {cpu:.1f}% ({cpu / max(len(bots), 1):.2f}% per client)")
+    print(f"  received by bots   {received / seconds / 1024:.1f} KiB/s, "
+          f"{sum(bot.missed for bot in bots)} of {sum(bot.updates for bot in bots)} updates missed")
+    if inputs.values:
+        print(f"  input applied      p50 {inputs.percentile(50) * 1000:.0f} ms, p99 {inputs.percentile(99) * 1000:.0f} ms"
+              f" ({inputs.count} turns)")
+        print(f"  input to update    p50 {updates.percentile(50) * 1000:.0f} ms, p99 {updates.percentile(99) * 1000:.0f} ms")
+
+def arena(snakeCount, length=20, seed=1):
+    # A full-size game with snakeCount snakes grown to length and some turns made
+    game = Game(seed=seed, appleCount=3)
+    for snake_id in range(snakeCount):
+        spawn = game.spawn_position(length, room=2)
+        if spawn is None:
+            break
+        game.add_snake(game.new_snake(snake_id, *spawn, color=(0, 255, 0)))
+    game.place_apples()
+    return game
+
+def micro_benchmarks(snakeCount=16, number=2000):
+    # Microseconds per call. A tick moves snakes that may crash, so every round of the tick
+    # benchmark starts from a fresh arena.
+    rng = random.Random(2)
+    def tick_round():
+        game = arena(snakeCount)
+        for _ in range(20):
+            for snake in game.snakes:
+                if rng.random() < 0.2:
+                    game.inputs.enqueue(snake.id, rng.choice((UP, DOWN, LEFT, RIGHT)))
+            game.step()
+    setup = timeit.timeit(lambda: arena(snakeCount), number=number // 20)
+    tick = (timeit.timeit(tick_round, number=number // 20) - setup) / number
+
+    game = arena(snakeCount)
+    updates = BoardUpdates(game)
+    keyframe = updates.next(True)
+    sentAtKeyframe = dict(updates.sent)
+    game.step()
+    delta = updates.next(False)
+    deltaFrame, keyframeFrame = encode_frame(delta), encode_frame(keyframe)
+    deltaPayload = encode(delta)
+    decodedDelta, decodedKeyframe = decode(deltaFrame[2:]), decode(keyframeFrame[2:])
+    stream = deltaFrame * 100
+
+    def build_delta():
+        # as if the last tick was the first since the keyframe
+        updates.sent = dict(sentAtKeyframe)
+        updates.next(False)
+
+    class Stream:
+        # Hands out the stream like recv_into() on a socket, in 4 KiB reads
+        def __init__(self):
+            self.position = 0
+        def recv_into(self, view):
+            count = min(len(view), 4096, len(stream) - self.position)
+            view[:count] = stream[self.position:self.position + count]
+            self.position += count
+            return count
+
+    def read_stream():
+        reader, source = FrameReader(), Stream()
+        while reader.fill(source):
+            for payload in reader.frames():
+                pass
+
+    def apply_keyframe():
+        board = new_board()
+        apply_board_update(board, decodedKeyframe)
+        return board
+
+    def copy_board(board):
+        # apply_board_update() changes the board in place, so every applied delta gets a copy
+        return dict(board, changes=[], snakes={snake_id: dict(snake, coords=deque(snake['coords']))
+                                               for snake_id, snake in board['snakes'].items()})
+
+    def bench(function, runs=number):
+        return timeit.timeit(function, number=runs) / runs * 1e6
+
+    atKeyframe = apply_keyframe()
+    boards = [copy_board(atKeyframe) for _ in range(number)]
+    results = [
+        (f'tick, {snakeCount} snakes', tick * 1e6),
+        ('build keyframe', bench(updates.keyframe)),
+        ('build delta', bench(build_delta)),
+        (f'encode delta ({len(deltaFrame)} bytes)', bench(lambda: encode_frame(delta))),
+        (f'encode keyframe ({len(keyframeFrame)} bytes)', bench(lambda: encode_frame(keyframe))),
+        ('decode delta', bench(lambda: decode(deltaFrame[2:]))),
+        ('decode keyframe', bench(lambda: decode(keyframeFrame[2:]))),
+        ('frame an encoded delta', bench(lambda: frame(deltaPayload))),
+        ('read 100 frames in 4 KiB reads', bench(read_stream, number // 10)),
+        ('apply keyframe', bench(apply_keyframe)),
+        ('apply delta', bench(lambda: apply_board_update(boards.pop(), decodedDelta))),
+    ]
+    print(f"{'benchmark':<32} {'us/call':>10}")
+    for name, micros in results:
+        print(f"{name:<32} {micros:>10.2f}")
+    return results
+
+
+def check_metrics_endpoint():
+    # Serves a small page of every kind of metric family with serve_metrics() on a free port,
+    # scrapes it once and checks it against the text format, without the load test. Returns
+    # what failed, nothing when the endpoint works.
+    failures = []
+    histogram = Histogram()
+    for seconds in (0.0004, 0.0009, 0.003):
+        histogram.add(seconds)
+    page = Exposition()
+    page.add('networmy_clients', 'gauge', 'Connected clients.', 2)
+    page.add('networmy_client_bytes_sent_total', 'counter', 'Bytes sent to the client.',
+             [({'client': '127.0.0.1:5000', 'snake': 0}, 1200), ({'client': 'quote " and \\ backslash', 'snake': ''}, 0)])
+    page.histogram('networmy_tick_duration_seconds', 'Time to simulate and broadcast a tick.', histogram)
+    server = serve_metrics(('127.0.0.1', 0), page.text)
+    port = server.server_address[1]
+    try:
+        try:
+            samples = scrape_metrics(port)
+        except (OSError, ValueError) as e:
+            return [f'scraping /metrics: {e}']
+        expected = {
+            'networmy_clients': 2,
+            'networmy_client_bytes_sent_total{client="127.0.0.1:5000",snake="0"}': 1200,
+            'networmy_tick_duration_seconds_bucket{le="+Inf"}': 3,
+            'networmy_tick_duration_seconds_count': 3,
+        }
+        for name, value in expected.items():
+            if samples.get(name) != value:
+                failures.append(f'{name} is {samples.get(name)}, expected {value}')
+        buckets = [value for name, value in samples.items() if name.startswith('networmy_tick_duration_seconds_bucket')]
+        if buckets != sorted(buckets):
+            failures.append('histogram buckets are not cumulative')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/other', timeout=5)
+            failures.append('a path other than /metrics was served')
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                failures.append(f'a path other than /metrics gave HTTP {e.code}, expected 404')
+    finally:
+        server.shutdown()
+        server.server_close()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark networmy.')
+    parser.add_argument('--bots', type=int, default=8, help='bot clients of the load test (default: 8)')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the load test (default: 10)')
+    parser.add_argument('--strategy', choices=('random', 'scripted'), default='random',
+                        help='random turns, or every bot driving the same square (default: random)')
+    parser.add_argument('--asyncio', action='store_true', help='load test the --asyncio server')
+    parser.add_argument('--flood', type=int, default=0, metavar='CLIENTS',
+                        help='clients that join the load test a second in and flood the host with turns (default: 0)')
+    parser.add_argument('--micro', action='store_true', help='only run the micro-benchmarks')
+    parser.add_argument('--snakes', type=int, default=16, help='snakes in the micro-benchmarks (default: 16)')
+    parser.add_argument('--check-metrics', action='store_true',
+                        help='only check the metrics endpoint against the Prometheus text format')
+    args = parser.parse_args()
+
+    if args.check_metrics:
+        failures = check_metrics_endpoint()
+        for failure in failures:
+            print(f"FAILED {failure}")
+        if failures:
+            sys.exit(1)
+        print("metrics endpoint serves the Prometheus text format")
+        return
+
+    micro_benchmarks(args.snakes)
+    if not args.micro:
+        print()
+        lines, bots, profile, metrics = load_test(args.bots, args.seconds, args.strategy, args.asyncio, flood=args.flood)
+        report_load_test(lines, bots, args.seconds)
+        if metrics:
+            report_metrics(metrics)
+        if profile:
+            print()
+            print('\n'.join(profile))
+
+
+if __name__ == '__main__':
+    main()
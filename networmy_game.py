@@ -0,0 +1,473 @@
+# Networmy game rules
+# Movement and collisions for all snakes on the board, without any pygame or network code.
+
+import random
+import threading
+from array import array
+from collections import deque
+from itertools import accumulate, chain, islice
+from operator import sub
+
+CELLWIDTH = 80
+CELLHEIGHT = 45
+
+UP = 0
+DOWN = 1
+LEFT = 2
+RIGHT = 3
+
+HEAD = 0 # syntactic sugar: index of the worm's head
+
+OPPOSITE = {UP: DOWN, DOWN: UP, LEFT: RIGHT, RIGHT: LEFT}
+MAX_QUEUED_TURNS = 3 # turns a player can queue ahead of the snake
+
+START_LENGTH = 3 # cells of a new snake
+START_ROOM = 5   # free cells a new snake gets ahead of it
+
+
+class OccupancyGrid:
+    # Flat width x height grid holding, for every cell, 1 + the id of the snake on it (0 when the
+    # cell is free). Updated incrementally as heads are added and tails removed, so checking a
+    # cell never depends on how long the snakes are.
+    #
+    # Cells are addressed by their index y * width + x; coords[index] gives back (x, y).
+    #
+    # The cells nobody occupies or reserved (for an apple) are also kept in the array free, in
+    # no particular order, with slots giving every cell's position in it (-1 when taken). Taking
+    # a cell swaps the last free cell into its slot, so keeping the set up to date is O(1)
+    # however crowded the board is.
+
+    def __init__(self, width=CELLWIDTH, height=CELLHEIGHT):
+        self.width = width
+        self.height = height
+        self.cells = array('H', bytes(2 * width * height))
+        self.coords = [(x, y) for y in range(height) for x in range(width)]
+        self.free = array('H' if width * height <= 0x10000 else 'I', range(width * height))
+        self.freeCount = width * height
+        self.slots = array('l', range(width * height))
+
+    def index(self, x, y):
+        return y * self.width + x
+
+    def neighbour(self, cell, direction):
+        # Index of the next cell in the direction, None past the edge of the board
+        x, y = self.coords[cell]
+        if direction == UP:
+            return cell - self.width if y > 0 else None
+        elif direction == DOWN:
+            return cell + self.width if y < self.height - 1 else None
+        elif direction == LEFT:
+            return cell - 1 if x > 0 else None
+        elif direction == RIGHT:
+            return cell + 1 if x < self.width - 1 else None
+
+    def owner(self, cell):
+        # Id of the snake on the cell, None when the cell is free
+        value = self.cells[cell]
+        return value - 1 if value else None
+
+    def occupy(self, cell, snake_id):
+        self.cells[cell] = snake_id + 1
+        self.reserve(cell)
+
+    def clear(self, cell):
+        self.cells[cell] = 0
+        self.release(cell)
+
+    def is_free(self, cell):
+        return self.slots[cell] >= 0
+
+    def reserve(self, cell):
+        # Takes the cell out of the free set
+        slot = self.slots[cell]
+        if slot < 0:
+            return
+        self.freeCount -= 1
+        last = self.free[self.freeCount]
+        self.free[slot] = last
+        self.slots[last] = slot
+        self.slots[cell] = -1
+
+    def release(self, cell):
+        if self.slots[cell] >= 0:
+            return
+        self.free[self.freeCount] = cell
+        self.slots[cell] = self.freeCount
+        self.freeCount += 1
+
+    def random_free(self, rng):
+        # A uniformly random free cell, None when the board is full. Which cell that is depends on
+        # the order of the free set, so a recording keeps that order in its keyframes.
+        if self.freeCount == 0:
+            return None
+        return self.free[rng.randrange(self.freeCount)]
+
+    def free_cells(self):
+        # The free set in its current order
+        return self.free[:self.freeCount]
+
+    def restore_free(self, cells):
+        # Puts the free set back in the order free_cells() gave, e.g. from a recording's keyframe;
+        # cells has to hold the cells that are free on this grid
+        self.free[:len(cells)] = array(self.free.typecode, cells)
+        self.freeCount = len(cells)
+        self.slots = array('l', [-1]) * len(self.cells)
+        for slot, cell in enumerate(cells):
+            self.slots[cell] = slot
+
+    def add_snake(self, snake):
+        for cell in snake.cells():
+            self.occupy(cell, snake.id)
+
+    def remove_snake(self, snake):
+        for cell in snake.cells():
+            self.clear(cell)
+
+    def coords_of(self, cells):
+        return list(map(self.coords.__getitem__, cells))
+
+
+# Bodies as paths. The cells of a body are a chain of neighbours, so after the head each cell is
+# told apart by the direction it lies in from the one before it: 2 bits, four cells to a byte,
+# starting at the low bits. The wire protocol and the recordings store bodies this way; a
+# whole board of 3600 cells takes 900 bytes.
+SHIFTED = [bytes(value << shift & 0xFF for value in range(256)) for shift in (0, 2, 4, 6)] # bytes.translate() tables
+pathKeys = {}  # board width -> direction by the difference of two cell indices
+pathSteps = {} # board width -> the four cell index steps packed in every byte value
+
+def encode_path(cells, width):
+    # The directions of every cell after the first of a sequence of cell indices on a board
+    # width cells wide. Raises ValueError when two cells are not neighbours; a jump from one
+    # edge of the board to the other edge in the next row is not noticed.
+    keys = pathKeys.get(width)
+    if keys is None:
+        keys = pathKeys[width] = {-width: UP, width: DOWN, -1: LEFT, 1: RIGHT}.__getitem__
+    try:
+        directions = bytes(map(keys, map(sub, cells[1:], cells)))
+    except KeyError:
+        raise ValueError('cells of a path must be neighbours') from None
+    directions += bytes(-len(directions) % 4)
+    packed = (int.from_bytes(directions[0::4], 'little')
+              | int.from_bytes(directions[1::4].translate(SHIFTED[1]), 'little')
+              | int.from_bytes(directions[2::4].translate(SHIFTED[2]), 'little')
+              | int.from_bytes(directions[3::4].translate(SHIFTED[3]), 'little'))
+    return packed.to_bytes(len(directions) // 4, 'little')
+
+def decode_path(head, data, count, width):
+    # The count cell indices of a path starting at head, from the first (count + 2) // 4 bytes of data
+    steps = pathSteps.get(width)
+    if steps is None:
+        units = {UP: -width, DOWN: width, LEFT: -1, RIGHT: 1}
+        steps = pathSteps[width] = [tuple(units[byte >> shift & 3] for shift in (0, 2, 4, 6)) for byte in range(256)]
+    if count == 0:
+        return []
+    return list(accumulate(islice(chain.from_iterable(map(steps.__getitem__, data)), count - 1), initial=head))
+
+
+class Snake:
+    # A snake's body as a fixed-capacity ring buffer of cell indices, head first. Adding a head
+    # and dropping the tail are O(1) and no per-cell objects are allocated, however long the
+    # snake gets. The capacity defaults to a full board, which no snake can outgrow.
+    __slots__ = ('id', 'color', 'direction', 'body', 'head', 'length')
+
+    def __init__(self, snake_id, cells, direction, color=None, capacity=CELLWIDTH * CELLHEIGHT, typecode='H'):
+        self.id = snake_id
+        self.color = color
+        self.direction = direction
+        self.body = array(typecode, bytes(array(typecode).itemsize * capacity))
+        self.head = 0   # position of the head in body
+        self.length = 0
+        for cell in reversed(cells):
+            self.push_head(cell)
+
+    def __len__(self):
+        return self.length
+
+    def push_head(self, cell):
+        if self.length == len(self.body):
+            raise OverflowError('snake is longer than its capacity')
+        self.head = (self.head - 1) % len(self.body)
+        self.body[self.head] = cell
+        self.length += 1
+
+    def pop_tail(self):
+        self.length -= 1
+        return self.body[(self.head + self.length) % len(self.body)]
+
+    def cell(self, i):
+        # The i-th cell counted from the head
+        return self.body[(self.head + i) % len(self.body)]
+
+    def cells(self):
+        # The body from head to tail as an array of cell indices; a slice copy at C speed
+        end = self.head + self.length
+        if end <= len(self.body):
+            return self.body[self.head:end]
+        return self.body[self.head:] + self.body[:end - len(self.body)]
+
+
+class InputQueues:
+    # Pending turns of every snake. Each snake has its own short queue; enqueue() is called from
+    # the network side and drain() from the game tick, which takes the next turn of every snake
+    # at once, at most one per snake per tick. Turns that would not change the snake's heading (repeats, or reversing onto its
+    # own neck) are dropped on arrival, as are turns beyond MAX_QUEUED_TURNS.
+    #
+    # A turn can carry a stamp, any object the caller wants back: take_applied() returns the
+    # stamps of the turns applied since it was last called, e.g. to measure input latency.
+
+    def __init__(self, maxTurns=MAX_QUEUED_TURNS):
+        self.maxTurns = maxTurns
+        self.lock = threading.Lock()
+        self.queues = {}  # snake id -> deque of pending (direction, stamp)
+        self.planned = {} # snake id -> direction the snake has once its queue is drained
+        self.applied = [] # stamps of the turns taken since the last take_applied()
+
+    def add_snake(self, snake_id, direction):
+        with self.lock:
+            self.queues[snake_id] = deque()
+            self.planned[snake_id] = direction
+
+    def remove_snake(self, snake_id):
+        with self.lock:
+            self.queues.pop(snake_id, None)
+            self.planned.pop(snake_id, None)
+
+    def enqueue(self, snake_id, direction, stamp=None):
+        # Returns True when the turn was queued
+        with self.lock:
+            queue = self.queues.get(snake_id)
+            if queue is None or len(queue) >= self.maxTurns:
+                return False
+            planned = self.planned[snake_id]
+            if direction == planned or direction == OPPOSITE[planned]:
+                return False
+            queue.append((direction, stamp))
+            self.planned[snake_id] = direction
+            return True
+
+    def drain(self, snake_ids):
+        # Pops the next turn of every snake that has one queued, as {snake id: direction}, under
+        # one lock rather than one per snake
+        turns = {}
+        with self.lock:
+            for snake_id in snake_ids:
+                queue = self.queues.get(snake_id)
+                if queue:
+                    direction, stamp = queue.popleft()
+                    turns[snake_id] = direction
+                    if stamp is not None:
+                        self.applied.append(stamp)
+        return turns
+
+    def depths(self):
+        # Turns waiting per snake, {snake id: count}
+        with self.lock:
+            return {snake_id: len(queue) for snake_id, queue in self.queues.items()}
+
+    def take_applied(self):
+        with self.lock:
+            applied, self.applied = self.applied, []
+            return applied
+
+
+def advance_snakes(snakes, grid, apples=()):
+    # Moves every snake one cell in its direction and returns the (snake, reason) pairs of the
+    # snakes that crashed. Crashed snakes are taken off the grid but left in the list. A snake
+    # whose head moves onto one of the apples (cell indices) grows: its tail stays put.
+    #
+    # All snakes move at the same time: every tail leaves its cell first, then every new head is
+    # checked against the walls, the bodies on the grid and the other new heads. Heads that meet
+    # on the same cell all crash, so the outcome never depends on the order of the snakes list.
+    moves = [(snake, grid.neighbour(snake.cell(HEAD), snake.direction)) for snake in snakes]
+
+    for snake, newHead in moves:
+        if newHead not in apples:
+            grid.clear(snake.pop_tail())
+
+    crashed = {}
+    claims = {} # cell -> snakes whose new head lands there
+    for snake, newHead in moves:
+        if newHead is None:
+            crashed[snake.id] = (snake, 'the boundary')
+            continue
+        owner = grid.owner(newHead)
+        if owner == snake.id:
+            crashed[snake.id] = (snake, 'itself')
+        elif owner is not None:
+            crashed[snake.id] = (snake, f'snake {owner}')
+        else:
+            claims.setdefault(newHead, []).append(snake)
+
+    for cell, claimants in claims.items():
+        if len(claimants) > 1:
+            for snake in claimants:
+                crashed[snake.id] = (snake, 'another head')
+
+    for snake, newHead in moves:
+        if snake.id in crashed:
+            continue
+        snake.push_head(newHead)
+        grid.occupy(newHead, snake.id)
+
+    for snake, reason in crashed.values():
+        grid.remove_snake(snake)
+    return list(crashed.values())
+
+
+class Game:
+    # One match: the snakes, the grid they occupy and their pending turns. step() advances the
+    # whole board by one tick; nothing in here knows about time, the network or the screen.
+    #
+    # Everything random comes from self.random, seeded with self.seed, so the same seed and the
+    # same turns (self.turns after every step) replay the same match.
+    #
+    # appleCount apples (cell indices in self.apples) lie on free cells; a snake that eats one
+    # grows by a cell and a new apple appears elsewhere.
+
+    def __init__(self, width=CELLWIDTH, height=CELLHEIGHT, seed=None, appleCount=0):
+        self.width = width
+        self.height = height
+        self.grid = OccupancyGrid(width, height)
+        self.inputs = InputQueues()
+        self.snakes = []
+        self.apples = set()
+        self.appleCount = appleCount
+        self.tick = 0
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.turns = [] # (snake id, direction) of the snakes that turned in the last step
+
+    def add_snake(self, snake):
+        self.snakes.append(snake)
+        self.grid.add_snake(snake)
+        self.inputs.add_snake(snake.id, snake.direction)
+
+    def step(self, turns=None):
+        # Returns the (snake, reason) pairs of the snakes that crashed this tick. A replay passes
+        # the recorded turns as {snake id: direction} instead of taking them from the inputs.
+        if turns is None:
+            # Every snake takes at most one of its own queued turns per tick
+            turns = self.inputs.drain([snake.id for snake in self.snakes])
+        self.turns = []
+        for snake in self.snakes:
+            direction = turns.get(snake.id, snake.direction)
+            if direction != snake.direction:
+                snake.direction = direction
+                self.turns.append((snake.id, direction))
+
+        # Move all snakes at once; collisions with walls, themselves and each other are checked on the grid
+        crashed = advance_snakes(self.snakes, self.grid, self.apples)
+        for snake, reason in crashed:
+            self.snakes.remove(snake)
+            self.inputs.remove_snake(snake.id)
+        if self.apples:
+            for snake in self.snakes:
+                self.apples.discard(snake.cell(HEAD)) # eaten
+        self.place_apples()
+        self.tick += 1
+        return crashed
+
+    def place_apples(self):
+        # Tops the apples up to appleCount, on random free cells
+        while len(self.apples) < self.appleCount:
+            cell = self.grid.random_free(self.random)
+            if cell is None:
+                return
+            self.grid.reserve(cell)
+            self.apples.add(cell)
+
+    def spawn_position(self, length=START_LENGTH, room=START_ROOM, attempts=100):
+        # A random free spot for a new snake: its (x, y) cells head first and its direction. The
+        # snake lies horizontally, heading for the wider side of the board with room free cells
+        # ahead. None when no spot turned up in the given number of attempts.
+        for _ in range(attempts):
+            cell = self.grid.random_free(self.random)
+            if cell is None:
+                return None
+            x, y = self.grid.coords[cell]
+            direction, dx = (RIGHT, 1) if x < self.width // 2 else (LEFT, -1)
+            cells = [x - dx * i for i in range(length)] + [x + dx * i for i in range(1, room + 1)]
+            if all(0 <= cx < self.width and self.grid.is_free(self.grid.index(cx, y)) for cx in cells):
+                return [(x - dx * i, y) for i in range(length)], direction
+        return None
+
+    def new_snake(self, snake_id, coords, direction, color=None, capacity=None):
+        # Builds a snake for this board from its (x, y) cells, head first. Without a capacity
+        # the snake can grow to fill the whole board.
+        cellCount = self.width * self.height
+        typecode = 'H' if cellCount <= 0x10000 else 'I' # cell indices of larger boards need 32 bits
+        return Snake(snake_id, [self.grid.index(x, y) for x, y in coords], direction, color,
+                     capacity or cellCount, typecode)
+
+    def random_location(self):
+        return self.random.randrange(self.width), self.random.randrange(self.height)
+
+    def coords(self, snake):
+        # The snake's cells as (x, y), head first
+        return self.grid.coords_of(snake.cells())
+
+
+class BoardUpdates:
+    # Builds the board_update messages that keep the clients' copies of a game in sync. A
+    # keyframe carries every snake in full. A delta only carries, per snake, the new head cells,
+    # how many tail cells to drop and the snakes that died since the previous update.
+
+    def __init__(self, game):
+        self.game = game
+        self.sent = {} # snake id -> (head cell index, length) as last sent
+
+    def snake_message(self, snake):
+        return {
+            'id': snake.id,
+            'coords': self.game.coords(snake),
+            'color': snake.color,
+            'direction': snake.direction
+        }
+
+    def apples(self):
+        return self.game.grid.coords_of(sorted(self.game.apples))
+
+    def keyframe(self):
+        # A keyframe of the current board that does not count as sent, e.g. to resync one client
+        return {'type': 'board_update', 'tick': self.game.tick, 'keyframe': True,
+                'snakes': [self.snake_message(snake) for snake in self.game.snakes],
+                'apples': self.apples()}
+
+    def next(self, keyframe):
+        game = self.game
+        if keyframe:
+            game_update = self.keyframe()
+        else:
+            game_update = {'type': 'board_update', 'tick': game.tick, 'keyframe': False}
+            moves = []
+            spawned = []
+            for snake in game.snakes:
+                sent = self.sent.get(snake.id)
+                if sent is None:
+                    spawned.append(self.snake_message(snake))
+                    continue
+                sentHead, sentLength = sent
+                heads = []
+                for i in range(len(snake)):
+                    cell = snake.cell(i)
+                    if cell == sentHead:
+                        break
+                    heads.append(cell)
+                else:
+                    # the previously sent head is gone, resend this snake in full
+                    spawned.append(self.snake_message(snake))
+                    continue
+                moves.append({
+                    'id': snake.id,
+                    'heads': game.grid.coords_of(heads),
+                    'tails': sentLength + len(heads) - len(snake),
+                    'direction': snake.direction
+                })
+            alive = {snake.id for snake in game.snakes}
+            game_update['moves'] = moves
+            game_update['spawned'] = spawned
+            game_update['dead'] = [snake_id for snake_id in self.sent if snake_id not in alive]
+            game_update['apples'] = self.apples()
+
+        self.sent = {snake.id: (snake.cell(HEAD), len(snake)) for snake in game.snakes}
+        return game_update
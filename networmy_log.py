@@ -0,0 +1,82 @@
+# Networmy logging
+# Keeps logging off the host's game and network threads. A log call there only checks the rate
+# limit and puts the record on a queue; a listener thread formats it and does the I/O. Messages
+# are formatted lazily, so pass the values as arguments: log.info("Connected by %s", addr).
+#
+# Every category of message gets its own rate limit, a category being a logger and a message
+# template: "Connected by %s" is one category whatever the address. Records over the limit are
+# dropped and counted, and the next record of the category that gets through says how many.
+# A client flooding errors can then not drown out the rest, nor slow the tick down.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LOG_RATE = 5    # records per second each category may log in the long run
+LOG_BURST = 20  # records a category may log at once after being quiet
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    # A token bucket per category
+
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {} # (logger name, template) -> [tokens, time of the last refill, records dropped]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.dropped = bucket[2] # added to the message by the formatter
+            bucket[2] = 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the message on the logging thread; this leaves it to the
+    # listener. The arguments of a log call must therefore not change after the call.
+
+    def prepare(self, record):
+        return record
+
+
+class DroppedFormatter(logging.Formatter):
+
+    def format(self, record):
+        text = super().format(record)
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            text += f" ({dropped} more like this dropped)"
+        return text
+
+
+def setup_logging(level=logging.INFO, rate=LOG_RATE, burst=LOG_BURST, stream=None):
+    # Routes the root logger through the queue; returns the listener, stopped at exit
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(RateLimitFilter(rate, burst))
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(DroppedFormatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, output)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
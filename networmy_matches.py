@@ -0,0 +1,318 @@
+# Networmy tournament matches
+# Lets one host run a whole bracket. Every match simulates in its own worker process, so the
+# matches of a round play in parallel on all CPU cores, while the host process keeps all the
+# sockets: it routes each player's turns to the worker of their match and relays the worker's
+# encoded board updates back to the players.
+#
+# Players pick their first-round match with the match id of their join message. Winners are
+# moved on to their next match by the bracket; the other players stay connected as spectators
+# of nothing until they quit. A player whose connection drops during a match gets the seat back
+# by joining again with the session token of the match's start message.
+
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+
+from networmy_game import Game, BoardUpdates
+from networmy_protocol import encode_frame, NO_SNAKE
+from networmy_replay import Recorder
+
+# Processes are spawned, not forked: the host forks from a process full of socket threads
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+def run_match(match_id, players, conn, fps, keyframeInterval, appleCount, recordPath=None, maxCatchupTicks=5):
+    # Worker process of one match. players holds (snake id, coords, direction, colour) per seat.
+    # Turns arrive on conn as (snake id, direction), and (None, None) asks for a keyframe on the
+    # next tick. Every tick the board update goes back as ('update', frame, is keyframe) and the
+    # outcome as ('result', winning snake id or None).
+    game = Game(appleCount=appleCount)
+    for snake_id, coords, direction, color in players:
+        game.add_snake(game.new_snake(snake_id, coords, direction, color))
+    game.place_apples()
+    recorder = Recorder(recordPath, game, keyframeInterval) if recordPath is not None else None
+    updates = BoardUpdates(game)
+    conn.send(('update', encode_frame(updates.next(True)), True))
+
+    interval = 1 / fps
+    nextTick = time.perf_counter()
+    keyframeWanted = False
+    while len(game.snakes) > 1:
+        nextTick += interval
+        # take turns until the tick is due
+        while True:
+            delay = nextTick - time.perf_counter()
+            if delay <= 0 or not conn.poll(delay):
+                break
+            snake_id, direction = conn.recv()
+            if snake_id is None:
+                keyframeWanted = True # a player reconnected or fell behind
+            else:
+                game.inputs.enqueue(snake_id, direction)
+        if delay < -maxCatchupTicks * interval:
+            nextTick = time.perf_counter()
+
+        game.step()
+        if recorder is not None:
+            recorder.record(game)
+        keyframe = keyframeWanted or game.tick % keyframeInterval == 0
+        keyframeWanted = False
+        conn.send(('update', encode_frame(updates.next(keyframe)), keyframe))
+
+    if recorder is not None:
+        recorder.close()
+    winner = game.snakes[0].id if game.snakes else None
+    conn.send(('result', winner))
+    conn.close()
+
+
+class Bracket:
+    # Single elimination. Every first-round match seats playersPerMatch players and only its
+    # winner goes on; the winners of consecutive matches share the next round's matches,
+    # playersPerMatch at a time, until one match is left. Matches are numbered from 1, round
+    # after round.
+
+    def __init__(self, firstRound, playersPerMatch):
+        self.playersPerMatch = playersPerMatch
+        self.rounds = [] # match ids per round
+        self.seats = {}  # match id -> number of players it waits for
+        matchId = 1
+        count = firstRound
+        while True:
+            matches = list(range(matchId, matchId + count))
+            if self.rounds:
+                for match_id in matches:
+                    self.seats[match_id] = 0
+                for position in range(len(self.rounds[-1])):
+                    self.seats[matches[position // playersPerMatch]] += 1 # one seat per feeder match
+            else:
+                for match_id in matches:
+                    self.seats[match_id] = playersPerMatch
+            self.rounds.append(matches)
+            matchId += count
+            if count == 1:
+                break
+            count = -(-count // playersPerMatch)
+        self.results = {} # match id -> winner
+
+    def first_round(self):
+        return self.rounds[0]
+
+    def next_match(self, match_id):
+        # The match the winner of match_id plays next, None after the final
+        for number, matches in enumerate(self.rounds[:-1]):
+            if match_id in matches:
+                return self.rounds[number + 1][matches.index(match_id) // self.playersPerMatch]
+        return None
+
+    def record(self, match_id, winner):
+        self.results[match_id] = winner
+        return self.next_match(match_id)
+
+
+class Match:
+
+    def __init__(self, match_id, clients, process, conn):
+        self.id = match_id
+        self.clients = clients # seat i steers snake i
+        self.process = process
+        self.conn = conn
+        self.sendLock = threading.Lock() # turns come in on every client's thread
+
+
+class MatchManager:
+    # The lobby: clients wait in the match they joined until all its seats are taken, then the
+    # match starts in a worker process. broadcast(clients, frame, keyframe) hands the board
+    # updates relayed from a worker to the clients of that match. With a recordPath every match
+    # is recorded to a file of its own next to it.
+
+    def __init__(self, bracket, colors, broadcast, fps, keyframeInterval, appleCount, recordPath=None):
+        self.bracket = bracket
+        self.colors = colors
+        self.broadcast = broadcast
+        self.fps = fps
+        self.keyframeInterval = keyframeInterval
+        self.appleCount = appleCount
+        self.recordPath = recordPath
+        self.lock = threading.RLock()
+        self.seats = dict(bracket.seats) # seats still to be filled; shrinks when a feeder match has no winner
+        self.lobbies = {match_id: [] for match_id in bracket.seats} # matches that have not started
+        self.running = {}    # match id -> Match
+        self.clientSeats = {} # client -> (match id, snake id), snake id None while waiting or watching
+        self.sessions = {}    # session token -> (match id, snake id)
+        self.champion = None
+        self.finished = threading.Event()
+
+    def join(self, client, match_id, token=0):
+        # Returns False when match_id is not a first-round match that still takes players and
+        # token is not the session of a running match
+        with self.lock:
+            if token in self.sessions:
+                return self.rejoin(client, token)
+            if client in self.clientSeats:
+                return False
+            lobby = self.lobbies.get(match_id)
+            if lobby is None or match_id not in self.bracket.first_round() or len(lobby) >= self.seats[match_id]:
+                return False
+            lobby.append(client)
+            self.clientSeats[client] = (match_id, None)
+            logging.info("Client %s joined match %d (%d/%d)", client.addr, match_id, len(lobby), self.seats[match_id])
+            self.start_when_full(match_id)
+            return True
+
+    def rejoin(self, client, token):
+        # Puts a reconnected player back in its seat; the worker sends everyone a keyframe on
+        # the next tick, and the player's deltas wait for it
+        match_id, snake_id = self.sessions[token]
+        match = self.running.get(match_id)
+        if match is None:
+            return False
+        old = match.clients[snake_id]
+        if old is not client:
+            self.clientSeats.pop(old, None)
+            old.close() # the dropped connection, if the host has not noticed yet
+        match.clients[snake_id] = client
+        self.clientSeats[client] = (match_id, snake_id)
+        client.needsKeyframe = True
+        client.sendall(encode_frame({'type': 'start', 'id': snake_id, 'coords': [],
+                                     'color': self.colors[snake_id % len(self.colors)], 'token': token}))
+        self.request_keyframe(match)
+        logging.info("Client %s is back in match %d on snake %d", client.addr, match_id, snake_id)
+        return True
+
+    def resync(self, client):
+        # A player whose board fell behind gets a keyframe on the next tick of its match
+        with self.lock:
+            match_id, snake_id = self.clientSeats.get(client, (None, None))
+            match = self.running.get(match_id)
+            if match is None:
+                return
+            client.needsKeyframe = True
+        self.request_keyframe(match)
+
+    def request_keyframe(self, match):
+        # The worker sends everyone a keyframe on the next tick; deltas wait for it
+        with match.sendLock:
+            try:
+                match.conn.send((None, None))
+            except OSError:
+                pass
+
+    def leave(self, client):
+        # Leaving a first-round lobby frees the seat; the snake of a running match plays on without its player
+        with self.lock:
+            match_id, snake_id = self.clientSeats.pop(client, (None, None))
+            lobby = self.lobbies.get(match_id)
+            if lobby is not None and client in lobby:
+                lobby.remove(client)
+                if match_id not in self.bracket.first_round():
+                    # a winner that left: the match goes ahead without that seat
+                    self.seats[match_id] -= 1
+                    self.start_when_full(match_id)
+
+    def turn(self, client, direction):
+        with self.lock:
+            match_id, snake_id = self.clientSeats.get(client, (None, None))
+            match = self.running.get(match_id)
+        if match is None or snake_id is None:
+            return
+        with match.sendLock:
+            try:
+                match.conn.send((snake_id, direction))
+            except OSError:
+                pass # the match just ended
+
+    def start_when_full(self, match_id):
+        lobby = self.lobbies[match_id]
+        if len(lobby) < self.seats[match_id]:
+            return
+        del self.lobbies[match_id]
+        if len(lobby) < 2:
+            # a walkover: the only player left, if any, goes straight on
+            self.finish(match_id, lobby[0] if lobby else None)
+            return
+
+        players = []
+        layout = Game() # only to lay out the start positions
+        for snake_id, client in enumerate(lobby):
+            spawn = layout.spawn_position()
+            if spawn is None:
+                # the player watches the match instead; snake ids stay the lobby's indices
+                logging.warning("No room left on the board for client %s in match %d", client.addr, match_id)
+                self.clientSeats[client] = (match_id, None)
+                client.sendall(encode_frame({'type': 'start', 'id': NO_SNAKE, 'coords': [], 'color': (0, 0, 0),
+                                             'token': 0}))
+                continue
+            coords, direction = spawn
+            color = self.colors[snake_id % len(self.colors)]
+            layout.add_snake(layout.new_snake(snake_id, coords, direction, color))
+            players.append((snake_id, coords, direction, color))
+            self.clientSeats[client] = (match_id, snake_id)
+            token = secrets.randbits(32)
+            while token == 0 or token in self.sessions:
+                token = secrets.randbits(32)
+            self.sessions[token] = (match_id, snake_id)
+            client.sendall(encode_frame({'type': 'start', 'id': snake_id, 'coords': coords, 'color': color,
+                                         'token': token}))
+
+        recordPath = None
+        if self.recordPath is not None:
+            base, extension = os.path.splitext(self.recordPath)
+            recordPath = f'{base}-match{match_id}{extension}'
+        conn, workerConn = CONTEXT.Pipe()
+        process = CONTEXT.Process(target=run_match, name=f'match-{match_id}', daemon=True,
+                                  args=(match_id, players, workerConn, self.fps, self.keyframeInterval,
+                                        self.appleCount, recordPath))
+        process.start()
+        workerConn.close()
+        match = Match(match_id, lobby, process, conn)
+        self.running[match_id] = match
+        threading.Thread(target=self.relay, args=(match,), daemon=True).start()
+        print(f"Match {match_id} started with {len(lobby)} players")
+
+    def relay(self, match):
+        # Forwards the worker's board updates until it reports the result
+        winner = None
+        while True:
+            try:
+                message = match.conn.recv()
+            except (EOFError, OSError):
+                logging.error("Match %d ended without a result", match.id)
+                break
+            if message[0] == 'update':
+                self.broadcast(match.clients, message[1], message[2])
+            else:
+                winner = message[1]
+                break
+        with match.sendLock:
+            match.conn.close()
+        match.process.join()
+        gameOver = encode_frame({'type': 'game_over', 'winner': winner})
+        for client in match.clients:
+            client.sendall(gameOver)
+        with self.lock:
+            del self.running[match.id]
+            for token in [token for token, seat in self.sessions.items() if seat[0] == match.id]:
+                del self.sessions[token]
+            winnerClient = match.clients[winner] if winner is not None else None
+            if winnerClient is not None and winnerClient not in self.clientSeats:
+                winnerClient = None # won, but disconnected meanwhile
+            self.finish(match.id, winnerClient)
+
+    def finish(self, match_id, winner):
+        # Records the winning client (None when nobody survived) and seats it in its next match
+        next_match = self.bracket.record(match_id, winner)
+        print(f"Match {match_id} won by {winner.addr if winner is not None else 'nobody'}")
+        if next_match is None:
+            self.champion = winner
+            self.finished.set()
+            return
+        if winner is None:
+            self.seats[next_match] -= 1
+        else:
+            self.lobbies[next_match].append(winner)
+            self.clientSeats[winner] = (next_match, None)
+        self.start_when_full(next_match)
@@ -0,0 +1,232 @@
+# Networmy measurements
+# Rolling windows of recent samples with percentiles, and the latency figures the host keeps
+# per client: round trip time and jitter from ping/pong, how long frames wait in the client's
+# send queue, and how long a turn waits between arriving and being applied by a tick. A slow
+# laptop shows up as queueing and input delay with a clean RTT; a congested network as a high
+# or jittery RTT.
+#
+# For the host's own time there are histograms per phase of the tick, which keep every tick
+# of a long game in a few dozen counters.
+#
+# serve_metrics() publishes all of it over HTTP in the Prometheus text format, for a dashboard
+# during a tournament. The counters behind it are plain attributes bumped where the work is
+# done anyway; all the formatting happens when the endpoint is scraped.
+
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+
+class Samples:
+    # The last size values of a measurement
+
+    def __init__(self, size=256):
+        self.values = deque(maxlen=size)
+        self.count = 0 # all samples ever added
+
+    def add(self, value):
+        self.values.append(value)
+        self.count += 1
+
+    def percentile(self, percent):
+        # Nearest-rank percentile of the window, None without samples
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+
+class ClientLatency:
+    # All times in seconds
+
+    def __init__(self):
+        self.rtt = Samples()
+        self.queueing = Samples()
+        self.input = Samples()
+        self.jitter = 0.0 # smoothed RTT variation, as RFC 3550 does for packet arrival times
+        self.lastRtt = None
+
+    def add_rtt(self, rtt):
+        if self.lastRtt is not None:
+            self.jitter += (abs(rtt - self.lastRtt) - self.jitter) / 16
+        self.lastRtt = rtt
+        self.rtt.add(rtt)
+
+    def summary(self):
+        # Milliseconds, None where nothing was measured yet
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+        return {
+            'rtt_p50_ms': ms(self.rtt.percentile(50)),
+            'rtt_p99_ms': ms(self.rtt.percentile(99)),
+            'jitter_ms': ms(self.jitter if self.rtt.count > 1 else None),
+            'queue_p50_ms': ms(self.queueing.percentile(50)),
+            'queue_p99_ms': ms(self.queueing.percentile(99)),
+            'input_p50_ms': ms(self.input.percentile(50)),
+            'input_p99_ms': ms(self.input.percentile(99)),
+        }
+
+    def describe(self):
+        # One line for a screen
+        summary = self.summary()
+        if summary['rtt_p50_ms'] is None:
+            return 'no ping yet'
+        text = f"rtt {summary['rtt_p50_ms']:.0f}/{summary['rtt_p99_ms']:.0f} ms, jitter {summary['jitter_ms'] or 0:.0f} ms"
+        if summary['input_p50_ms'] is not None:
+            text += f", input {summary['input_p50_ms']:.0f}/{summary['input_p99_ms']:.0f} ms"
+        return text
+
+
+class Histogram:
+    # Durations counted in buckets that double in width: bucket 0 holds everything under
+    # smallest, bucket i up to smallest * 2**i, and the last bucket the rest. Adding a value is
+    # a division and a bit_length(), cheap enough to do for every phase of every tick.
+
+    def __init__(self, smallest=1e-6, buckets=24):
+        self.smallest = smallest
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds / self.smallest).bit_length(), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        # The upper bound of the bucket holding the percentile, None without values
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * percent // 100))
+        for bucket, count in enumerate(self.counts):
+            rank -= count
+            if rank <= 0:
+                return min(self.smallest * 2 ** bucket, self.max)
+        return self.max
+
+
+class TickProfiler:
+    # A histogram per phase of the tick. start() at the beginning of a tick, then lap(phase)
+    # after each phase charges the time since the previous lap to it. Work that runs outside the
+    # tick, like drawing on another thread, times itself and calls add().
+
+    def __init__(self, phases):
+        self.phases = list(phases)
+        self.histograms = {phase: Histogram() for phase in self.phases}
+        self.last = 0.0
+
+    def start(self):
+        self.last = perf_counter()
+        return self.last
+
+    def lap(self, phase):
+        now = perf_counter()
+        self.histograms[phase].add(now - self.last)
+        self.last = now
+        return now
+
+    def add(self, phase, seconds):
+        self.histograms[phase].add(seconds)
+
+    def report(self):
+        # A table of every phase, then the bucket counts of the phases that ran
+        lines = [f"{'phase':<12} {'count':>8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'max us':>9}"]
+        for phase in self.phases:
+            histogram = self.histograms[phase]
+            if histogram.count:
+                lines.append(f"{phase:<12} {histogram.count:>8} {histogram.total / histogram.count * 1e6:>9.1f} "
+                             f"{histogram.percentile(50) * 1e6:>9.0f} {histogram.percentile(99) * 1e6:>9.0f} "
+                             f"{histogram.max * 1e6:>9.0f}")
+        for phase in self.phases:
+            histogram = self.histograms[phase]
+            if histogram.count:
+                lines.append(f"{phase}: " + ', '.join(
+                    f"<{histogram.smallest * 2 ** bucket * 1e6:.0f}us {count}"
+                    for bucket, count in enumerate(histogram.counts) if count))
+        return '\n'.join(lines)
+
+
+class ClientCounters:
+    # Traffic of one client. The host adds to the counters of a threaded client under a lock per
+    # direction, since two threads can add to one: the reading thread and the UDP channel to the
+    # ones in, the writer and the tick (with the datagrams) to the ones out. The scraping thread
+    # reads them without one.
+    __slots__ = ('bytesIn', 'bytesOut', 'messagesIn', 'messagesOut', 'droppedUpdates', 'droppedMessages',
+                 'coalescedTurns')
+
+    def __init__(self):
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.messagesIn = 0
+        self.messagesOut = 0
+        self.droppedUpdates = 0 # board updates thrown away for a keyframe because the client lagged
+        self.droppedMessages = 0 # messages from the client over its rate limit, never decoded
+        self.coalescedTurns = 0 # repeats of the client's last turn, never queued
+
+
+class Exposition:
+    # Builds a page in the Prometheus text format, one metric family at a time
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help, samples):
+        # samples: (labels dict, value) pairs, or a plain value for a family without labels
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def histogram(self, name, help, histogram):
+        # A Histogram's doubling buckets as cumulative Prometheus buckets; its last bucket is +Inf
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bucket, count in enumerate(histogram.counts[:-1]):
+            cumulative += count
+            self.lines.append(f'{name}_bucket{{le="{histogram.smallest * 2 ** bucket:.6g}"}} {cumulative}')
+        self.lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        self.lines.append(f"{name}_sum {histogram.total:.9g}")
+        self.lines.append(f"{name}_count {histogram.count}")
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def serve_metrics(address, render):
+    # Serves render(), which returns the page, at http://address/metrics on a daemon thread.
+    # Returns the server; its server_address has the port when address asked for port 0.
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # a scrape every few seconds is not worth a log line
+
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
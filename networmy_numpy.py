@@ -0,0 +1,208 @@
+# Networmy NumPy engine
+# The rules of networmy_game.Game for bot arenas and AI training, where hundreds of snakes on a
+# large board make a per-snake Python loop too slow. All heads, directions and bodies live in
+# NumPy arrays and a tick moves, checks and kills the whole population in one batched step.
+#
+# Needs NumPy, which the host and client do not: import this module only where it is used.
+#
+#   python networmy_numpy.py    checks it against the reference engine and benchmarks both
+
+import sys
+
+import numpy as np
+
+from networmy_game import UP, DOWN, LEFT, RIGHT, OPPOSITE, Game
+
+# Crash reasons, indexes into REASONS
+ALIVE, BOUNDARY, ITSELF, OTHER, HEAD_ON = range(5)
+REASONS = [None, 'the boundary', 'itself', 'snake {}', 'another head']
+
+DX = np.array([0, 0, -1, 1])    # indexed by UP, DOWN, LEFT, RIGHT
+DY = np.array([-1, 1, 0, 0])
+OPPOSITES = np.array([OPPOSITE[direction] for direction in (UP, DOWN, LEFT, RIGHT)])
+
+
+class NumpyGame:
+    # Snake i has id ids[i]. Its body is a ring buffer in row i of bodies, with the head at
+    # column heads[i] and lengths[i] cells following it (wrapping around). The grid holds
+    # 1 + the id of the snake on each cell, 0 when the cell is free.
+
+    def __init__(self, width, height, ids, bodies, directions, capacity=1024):
+        count = len(ids)
+        self.width = width
+        self.height = height
+        self.tick = 0
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.directions = np.asarray(directions, dtype=np.int64)
+        self.alive = np.ones(count, dtype=bool)
+        self.lengths = np.array([len(body) for body in bodies], dtype=np.int64)
+        if count and self.lengths.max() > capacity:
+            raise ValueError('a snake is longer than the capacity')
+        self.bodies = np.zeros((count, capacity), dtype=np.int64)
+        for i, body in enumerate(bodies):
+            self.bodies[i, :len(body)] = body
+        self.heads = np.zeros(count, dtype=np.int64)
+        self.grid = np.zeros(width * height, dtype=np.int64)
+        for i, body in enumerate(bodies):
+            self.grid[np.asarray(body, dtype=np.int64)] = self.ids[i] + 1
+
+    @classmethod
+    def from_game(cls, game, capacity=1024):
+        # Same board as a networmy_game.Game, which must not have queued turns
+        return cls(game.width, game.height,
+                   [snake.id for snake in game.snakes],
+                   [list(snake.cells()) for snake in game.snakes],
+                   [snake.direction for snake in game.snakes],
+                   capacity)
+
+    def cells(self, i):
+        # Body of snake i from head to tail as cell indices
+        capacity = self.bodies.shape[1]
+        return self.bodies[i, (self.heads[i] + np.arange(self.lengths[i])) % capacity]
+
+    def step(self, turns=None):
+        # Advances all living snakes by one tick. turns holds a direction per snake, or -1 for
+        # none; a turn that reverses the snake is ignored. Returns the indexes of the snakes
+        # that crashed this tick and their reasons (ALIVE, BOUNDARY, ... codes).
+        width, height = self.width, self.height
+        capacity = self.bodies.shape[1]
+        live = np.flatnonzero(self.alive)
+
+        directions = self.directions[live]
+        if turns is not None:
+            wanted = np.asarray(turns)[live]
+            valid = (wanted >= 0) & (wanted != OPPOSITES[directions])
+            directions = np.where(valid, wanted, directions)
+            self.directions[live] = directions
+
+        headCells = self.bodies[live, self.heads[live]]
+        x = headCells % width + DX[directions]
+        y = headCells // width + DY[directions]
+        reasons = np.where((x < 0) | (x >= width) | (y < 0) | (y >= height), BOUNDARY, ALIVE)
+        newHeads = np.clip(y, 0, height - 1) * width + np.clip(x, 0, width - 1)
+
+        # tails leave before any head arrives
+        tailCells = self.bodies[live, (self.heads[live] + self.lengths[live] - 1) % capacity]
+        self.grid[tailCells] = 0
+        self.lengths[live] -= 1
+
+        owners = self.grid[newHeads] - 1
+        inside = reasons == ALIVE
+        reasons[inside & (owners == self.ids[live])] = ITSELF
+        reasons[inside & (owners >= 0) & (owners != self.ids[live])] = OTHER
+
+        # heads landing on the same cell: duplicates among the sorted new heads
+        moving = reasons == ALIVE
+        claimed = np.sort(newHeads[moving])
+        contested = claimed[1:][claimed[1:] == claimed[:-1]]
+        if len(contested):
+            reasons[moving & np.isin(newHeads, contested)] = HEAD_ON
+
+        moved = live[reasons == ALIVE]
+        movedHeads = newHeads[reasons == ALIVE]
+        self.heads[moved] = (self.heads[moved] - 1) % capacity
+        self.bodies[moved, self.heads[moved]] = movedHeads
+        self.lengths[moved] += 1
+        self.grid[movedHeads] = self.ids[moved] + 1
+
+        crashed = live[reasons != ALIVE]
+        if len(crashed):
+            longest = self.lengths[crashed].max()
+            offsets = np.arange(longest)
+            positions = (self.heads[crashed, None] + offsets) % capacity
+            cells = self.bodies[crashed[:, None], positions]
+            self.grid[cells[offsets < self.lengths[crashed, None]]] = 0
+            self.alive[crashed] = False
+        self.tick += 1
+        return crashed, reasons[reasons != ALIVE], owners[reasons != ALIVE]
+
+    def describe(self, crashed, reasons, owners):
+        # Crashes as (snake id, reason) pairs worded like networmy_game.advance_snakes()
+        return [(int(self.ids[i]), REASONS[reason].format(owner))
+                for i, reason, owner in zip(crashed, reasons, owners)]
+
+
+def arena(count, width, height, length=5, seed=0):
+    # A networmy_game.Game with count snakes of the given length laid out in rows
+    rng = np.random.default_rng(seed)
+    game = Game(width, height)
+    perRow = width // (length + 1)
+    rows = height // 2
+    if count > perRow * rows:
+        raise ValueError('board too small for that many snakes')
+    for snake_id in range(count):
+        row, column = divmod(snake_id, perRow)
+        x = column * (length + 1) + length - 1
+        y = row * 2
+        coords = [(x - i, y) for i in range(length)]
+        game.add_snake(game.new_snake(snake_id, coords, int(rng.choice([UP, DOWN, RIGHT])), capacity=length + 1))
+    return game
+
+def random_turns(rng, count, chance=0.2):
+    turns = rng.integers(0, 4, count)
+    return np.where(rng.random(count) < chance, turns, -1)
+
+def compare_with_reference(count=200, width=200, height=200, ticks=300, seed=1):
+    # Runs both engines on the same arena with the same random turns and checks every tick
+    # that they kill the same snakes for the same reasons and leave the same bodies behind.
+    # Returns what differed on the first tick the engines disagree on, nothing when they never
+    # do; there are no assert statements, so python -O checks just as much.
+    reference = arena(count, width, height, seed=seed)
+    engine = NumpyGame.from_game(reference)
+    rng = np.random.default_rng(seed)
+    for tick in range(ticks):
+        turns = random_turns(rng, count)
+        for snake in reference.snakes:
+            if turns[snake.id] >= 0:
+                reference.inputs.enqueue(snake.id, int(turns[snake.id]))
+        mismatches = []
+        expected = sorted((snake.id, reason) for snake, reason in reference.step())
+        crashes = sorted(engine.describe(*engine.step(turns)))
+        if crashes != expected:
+            mismatches.append(f'crashes differ on tick {tick}: {crashes} instead of {expected}')
+        alive = [int(i) for i in engine.ids[engine.alive]]
+        if alive != [snake.id for snake in reference.snakes]:
+            mismatches.append(f'snakes alive differ on tick {tick}')
+        for snake in reference.snakes:
+            if snake.id in alive and list(snake.cells()) != engine.cells(snake.id).tolist():
+                mismatches.append(f'snake {snake.id} differs on tick {tick}')
+        if not (np.asarray(reference.grid.cells) == engine.grid).all():
+            mismatches.append(f'grids differ on tick {tick}')
+        if mismatches:
+            return mismatches # the engines drift further apart from here on
+    return []
+
+def benchmark(counts=(8, 64, 256, 1024, 4096), width=400, height=400, ticks=100, seed=2):
+    # Ticks per second of both engines against the number of snakes. Snakes keep moving and
+    # dying, so the numbers are for a population that thins out over the run.
+    import time
+
+    print(f"{'snakes':>8} {'reference':>12} {'numpy':>12}   (ticks/s on {width}x{height})")
+    for count in counts:
+        rates = []
+        for vectorized in (False, True):
+            game = arena(count, width, height, seed=seed)
+            engine = NumpyGame.from_game(game) if vectorized else None
+            rng = np.random.default_rng(seed)
+            turnsPerTick = [random_turns(rng, count) for _ in range(ticks)]
+            start = time.perf_counter()
+            for turns in turnsPerTick:
+                if vectorized:
+                    engine.step(turns)
+                else:
+                    for snake in game.snakes:
+                        if turns[snake.id] >= 0:
+                            game.inputs.enqueue(snake.id, int(turns[snake.id]))
+                    game.step()
+            rates.append(ticks / (time.perf_counter() - start))
+        print(f"{count:>8} {rates[0]:>12.0f} {rates[1]:>12.0f}")
+
+
+if __name__ == '__main__':
+    mismatches = compare_with_reference()
+    for mismatch in mismatches:
+        print(f"FAILED {mismatch}")
+    if mismatches:
+        sys.exit(1)
+    print("numpy engine matches the reference engine")
+    benchmark()
@@ -0,0 +1,175 @@
+# Networmy projector
+# The host's projector view runs in a process of its own, so drawing the 1600x900 board and
+# pygame.display.update() happen on another core and never hold the GIL that the simulation and
+# the client threads need.
+#
+# After every tick the simulation publishes the board into a BoardBuffer, a block of shared
+# memory: the occupancy grid as it is (1 + the id of the snake on every cell, APPLE on the
+# apples) and a palette with the colour of every grid value. Nothing is pickled or sent per
+# frame. A seqlock keeps the projector from drawing a half-written board: the writer makes the
+# generation counter odd while it writes and even again when it is done, and the reader only
+# keeps its copy of the board if the generation was even and unchanged all the while. The writer
+# never waits for the reader; a reader that loses the race draws the next tick instead.
+#
+# A pipe carries what is left, which is little and rare: the caption with the players' latency
+# one way, the P key (print the tick profile) and the closing of the window the other way.
+
+import multiprocessing
+import struct
+import time
+from array import array
+from multiprocessing import shared_memory
+
+import pygame
+from pygame.locals import *
+
+from networmy_metrics import TickProfiler
+from networmy_protocol import APPLE_COLOR
+from networmy_render import BoardRenderer, darker
+
+APPLE = 0xFFFF # grid value of the apple cells; snake ids stay below APPLE - 1
+PALETTE_SIZE = 0x10000 # an RGB colour for every grid value
+HEADER = struct.Struct('<Q') # the seqlock's generation, odd while the board is being written
+
+# Spawned, not forked, like the tournament's match workers: pygame is initialised in the host
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+class BoardBuffer:
+    # The board in shared memory. The host creates it (no name) and writes to it with publish();
+    # the projector attaches to it by name and reads it with read().
+
+    def __init__(self, width, height, name=None):
+        cellBytes = 2 * width * height
+        size = HEADER.size + cellBytes + 3 * PALETTE_SIZE
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name, create=self.owner, size=size)
+        self.name = self.memory.name
+        self.cells = self.memory.buf[HEADER.size:HEADER.size + cellBytes].cast('H')
+        self.palette = self.memory.buf[HEADER.size + cellBytes:size]
+        self.generation = 0
+        self.colors = {} # grid value -> colour in the palette, of the writer
+
+    def publish(self, grid, snakes, apples):
+        generation = self.generation + 1
+        HEADER.pack_into(self.memory.buf, 0, generation)
+        for snake in snakes:
+            if self.colors.get(snake.id + 1) != snake.color:
+                self.set_color(snake.id + 1, snake.color)
+        if APPLE not in self.colors:
+            self.set_color(APPLE, APPLE_COLOR)
+        self.cells[:] = memoryview(grid.cells)
+        for cell in apples:
+            self.cells[cell] = APPLE
+        self.generation = generation + 1
+        HEADER.pack_into(self.memory.buf, 0, self.generation)
+
+    def set_color(self, value, color):
+        self.colors[value] = color
+        self.palette[3 * value:3 * value + 3] = bytes(color)
+
+    def read(self, seen=None):
+        # (generation, cells, {grid value: colour}) of the last board published, None while that
+        # is still the generation seen
+        while True:
+            generation = HEADER.unpack_from(self.memory.buf)[0]
+            if generation == seen:
+                return None
+            if generation & 1:
+                time.sleep(0) # the writer is done within microseconds
+                continue
+            cells = array('H')
+            cells.frombytes(self.cells.tobytes())
+            colors = {value: tuple(self.palette[3 * value:3 * value + 3]) for value in set(cells) if value}
+            if HEADER.unpack_from(self.memory.buf)[0] == generation:
+                return generation, cells, colors
+
+    def close(self):
+        self.cells.release()
+        self.palette.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class Projector:
+    # The host's end: the shared board, the pipe and the projector process
+
+    def __init__(self, width, height, cellSize, bgColor, gridColor, innerColors, fps):
+        self.board = BoardBuffer(width, height)
+        self.conn, projectorConn = CONTEXT.Pipe()
+        self.process = CONTEXT.Process(target=run_projector, name='projector', daemon=True,
+                                       args=(self.board.name, width, height, cellSize, bgColor, gridColor,
+                                             innerColors, fps, projectorConn))
+        self.process.start()
+        projectorConn.close()
+
+    def publish(self, game):
+        self.board.publish(game.grid, game.snakes, game.apples)
+
+    def set_caption(self, caption):
+        self.conn.send(('caption', caption))
+
+    def receive(self, timeout=0):
+        # The next message of the projector, ('profile',) or ('quit',), None when there was none
+        # within the timeout. A projector that went away quits.
+        try:
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError):
+            return ('quit',)
+        return None if self.process.is_alive() else ('quit',)
+
+    def close(self):
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.board.close()
+
+
+def run_projector(name, width, height, cellSize, bgColor, gridColor, innerColors, fps, conn):
+    # The projector process. It polls the board fps times a second and redraws the cells that
+    # changed since the board it drew last.
+    board = BoardBuffer(width, height, name)
+    pygame.init()
+    surface = pygame.display.set_mode((width * cellSize, height * cellSize))
+    pygame.display.set_caption('Wormy')
+    clock = pygame.time.Clock()
+    renderer = BoardRenderer(surface, cellSize, bgColor, gridColor,
+                             lambda color: innerColors.get(color) or darker(color))
+    renderer.reset()
+    profiler = TickProfiler(['render'])
+    coords = [(x, y) for y in range(height) for x in range(width)]
+    drawn = array('H', bytes(2 * width * height))
+    generation = None
+    try:
+        while True:
+            for event in pygame.event.get():
+                if event.type == QUIT:
+                    conn.send(('quit',))
+                    return
+                elif event.type == KEYDOWN and event.key == K_p:
+                    print(f"Projector profile:\n{profiler.report()}", flush=True)
+                    conn.send(('profile',))
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'caption':
+                    pygame.display.set_caption(message[1])
+
+            published = board.read(generation)
+            if published is not None:
+                started = time.perf_counter()
+                generation, cells, colors = published
+                for cell, value in enumerate(cells):
+                    if value != drawn[cell]:
+                        renderer.draw_cell(coords[cell], colors.get(value))
+                renderer.flush()
+                drawn = cells
+                profiler.add('render', time.perf_counter() - started)
+            clock.tick(fps)
+    except (EOFError, OSError):
+        pass # the host is gone
+    finally:
+        board.close()
+        pygame.quit()
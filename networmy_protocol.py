@@ -0,0 +1,542 @@
+# Networmy wire protocol
+# Shared by networmy-host.py and networmy-client.py.
+#
+# Every message is a length-prefixed frame holding a binary payload:
+#
+#   frame   = length (uint16) + payload
+#   payload = version (uint8) + message type (uint8) + tick (uint32) + body
+#
+# Cells are packed as two uint8 coordinates, colors as three uint8 channels. Snake bodies are
+# packed as paths (networmy_game.encode_path()): the head cell, then 2 bits per following cell
+# for the direction it lies in from the cell before it. A body of n cells takes
+# 2 + (n + 2) // 4 bytes, so even one snake filling the whole 80x45 board fits in about a kilobyte.
+# Messages are handled as plain dicts on both sides; encode() and decode()
+# convert between those dicts and the packed payload.
+#
+# With the optional UDP state channel, board updates and turns travel as datagrams
+# instead, while every other message stays on the TCP connection:
+#
+#   state datagram (host -> client) = sequence (uint32) + the last UDP_REDUNDANCY update frames
+#   input datagram (client -> host) = token (uint32) + sequence of the newest input (uint32)
+#                                     + number of inputs (uint8) + the last inputs, oldest first
+
+import struct
+import sys
+from array import array
+from collections import deque
+from itertools import chain, islice, repeat
+from operator import and_, rshift
+
+from networmy_game import encode_path, decode_path
+
+PROTOCOL_VERSION = 6
+
+MSG_START = 1
+MSG_KEYFRAME = 2
+MSG_DELTA = 3
+MSG_DIRECTION = 4
+MSG_QUIT = 5
+MSG_JOIN = 6
+MSG_GAME_OVER = 7
+MSG_UDP = 8
+MSG_PING = 9
+MSG_PONG = 10
+MSG_INPUT_APPLIED = 11
+MSG_RESYNC = 12 # a UDP client that lost more updates than a datagram repeats asks for a keyframe
+
+FRAME_HEADER = struct.Struct('!H')
+HEADER = struct.Struct('!BBI')      # version, message type, tick
+COUNT = struct.Struct('!B')
+SNAKE = struct.Struct('!B3BBH')     # id, color, direction, number of cells in the path
+MOVE = struct.Struct('!BBHB')       # id, direction, tails dropped, number of new heads
+START = struct.Struct('!B3BIH')     # id, color, session token, number of cells in the path
+DIRECTION = struct.Struct('!BI')    # direction, client clock in ms when it was sent
+TIMESTAMP = struct.Struct('!I')     # ping and pong: host clock in ms; input applied: the direction's client clock
+JOIN = struct.Struct('!HI')         # match id (0 for the host's own game), session token (0 for none)
+GAME_OVER = struct.Struct('!B')     # id of the winning snake, NO_WINNER when nobody survived
+
+UDP_TOKEN = struct.Struct('!I')     # token that ties the client's datagrams to its connection
+
+NO_WINNER = 0xFF
+NO_SNAKE = 0xFF # id in the start message of a spectator
+MAX_SNAKES = 0xFF # snake ids run from 0 to 254, the uint8 id fields keep 255 for none
+
+STATE_DATAGRAM = struct.Struct('!I')   # sequence
+INPUT_DATAGRAM = struct.Struct('!IIB') # token, sequence of the newest input, number of inputs
+UDP_REDUNDANCY = 3 # updates and inputs repeated in every datagram, so a few lost ones cost nothing
+
+MAX_FRAME_SIZE = 0xFFFF
+
+APPLE_COLOR = (255, 255, 255) # apples have no colour on the wire, every board draws them in this one, which no snake has
+
+MAX_PENDING_CHANGES = 4096 # past this many unrendered cell changes a board asks for a full redraw
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def pack_cells(cells):
+    try:
+        return bytes(chain.from_iterable(cells))
+    except ValueError:
+        raise ProtocolError('cell coordinates must fit in a byte') from None
+
+def unpack_cells(payload, offset, count):
+    end = offset + 2 * count
+    if end > len(payload):
+        raise ProtocolError('truncated cell list')
+    data = payload[offset:end]
+    return list(zip(data[0::2], data[1::2])), end
+
+def pack_path(coords):
+    # A chain of adjacent cells, head first; the number of cells is not included. The cells are
+    # read as x + 256 * y values to find the directions between them.
+    if not coords:
+        return b''
+    cells = pack_cells(coords)
+    values = array('H', cells)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    try:
+        directions = encode_path(values, 256)
+    except ValueError as e:
+        raise ProtocolError(str(e)) from None
+    if 255 in cells and any(abs(x - previousX) + abs(y - previousY) != 1
+                            for (previousX, previousY), (x, y) in zip(coords, islice(coords, 1, None))):
+        raise ProtocolError('cells of a path must be neighbours') # a jump from x 255 to x 0 or back
+    return cells[:2] + directions
+
+def unpack_path(payload, offset, count):
+    if count == 0:
+        return [], offset
+    end = offset + 2 + (count + 2) // 4
+    if end > len(payload):
+        raise ProtocolError('truncated path')
+    values = decode_path(payload[offset] | payload[offset + 1] << 8, payload[offset + 2:end], count, 256)
+    return list(zip(map(and_, values, repeat(0xFF)), map(rshift, values, repeat(8)))), end
+
+def _pack_snake(snake):
+    return SNAKE.pack(snake['id'], *snake['color'], snake['direction'], len(snake['coords'])) + pack_path(snake['coords'])
+
+def _unpack_snake(payload, offset):
+    snake_id, red, green, blue, direction, count = SNAKE.unpack_from(payload, offset)
+    coords, offset = unpack_path(payload, offset + SNAKE.size, count)
+    return {'id': snake_id, 'coords': coords, 'color': (red, green, blue), 'direction': direction}, offset
+
+def _pack_snakes(snakes):
+    return COUNT.pack(len(snakes)) + b''.join(_pack_snake(snake) for snake in snakes)
+
+def _unpack_snakes(payload, offset):
+    (count,) = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    snakes = []
+    for _ in range(count):
+        snake, offset = _unpack_snake(payload, offset)
+        snakes.append(snake)
+    return snakes, offset
+
+def _pack_apples(apples):
+    return COUNT.pack(len(apples)) + pack_cells(apples)
+
+def _unpack_apples(payload, offset):
+    (count,) = COUNT.unpack_from(payload, offset)
+    return unpack_cells(payload, offset + COUNT.size, count)
+
+# Messages that only carry a timestamp. An input_applied message echoes the 'sent' time of a
+# direction as its 'time' and has the tick that applied it as its tick.
+TIMESTAMPED = {'ping': MSG_PING, 'pong': MSG_PONG, 'input_applied': MSG_INPUT_APPLIED}
+TIMESTAMPED_TYPES = {msgType: name for name, msgType in TIMESTAMPED.items()}
+
+def clock_ms(seconds):
+    # A clock reading for a timestamp field; differences are taken modulo 2**32 by elapsed_ms()
+    return int(seconds * 1000) & 0xFFFFFFFF
+
+def elapsed_ms(start, end):
+    return (end - start) & 0xFFFFFFFF
+
+def encode(message):
+    msgType = message['type']
+    tick = message.get('tick', 0)
+    if msgType == 'board_update':
+        if message['keyframe']:
+            return (HEADER.pack(PROTOCOL_VERSION, MSG_KEYFRAME, tick) + _pack_snakes(message['snakes'])
+                    + _pack_apples(message['apples']))
+        parts = [HEADER.pack(PROTOCOL_VERSION, MSG_DELTA, tick), COUNT.pack(len(message['moves']))]
+        for move in message['moves']:
+            parts.append(MOVE.pack(move['id'], move['direction'], move['tails'], len(move['heads'])))
+            parts.append(pack_cells(move['heads']))
+        parts.append(_pack_snakes(message['spawned']))
+        parts.append(COUNT.pack(len(message['dead'])))
+        parts.append(bytes(message['dead']))
+        parts.append(_pack_apples(message['apples']))
+        return b''.join(parts)
+    elif msgType == 'direction':
+        return HEADER.pack(PROTOCOL_VERSION, MSG_DIRECTION, tick) + DIRECTION.pack(message['direction'], message.get('sent', 0))
+    elif msgType == 'start':
+        return (HEADER.pack(PROTOCOL_VERSION, MSG_START, tick)
+                + START.pack(message['id'], *message['color'], message['token'], len(message['coords']))
+                + pack_path(message['coords']))
+    elif msgType == 'quit':
+        return HEADER.pack(PROTOCOL_VERSION, MSG_QUIT, tick)
+    elif msgType == 'resync':
+        return HEADER.pack(PROTOCOL_VERSION, MSG_RESYNC, tick)
+    elif msgType == 'join':
+        return HEADER.pack(PROTOCOL_VERSION, MSG_JOIN, tick) + JOIN.pack(message['match'], message.get('token', 0))
+    elif msgType == 'game_over':
+        winner = NO_WINNER if message['winner'] is None else message['winner']
+        return HEADER.pack(PROTOCOL_VERSION, MSG_GAME_OVER, tick) + GAME_OVER.pack(winner)
+    elif msgType == 'udp':
+        return HEADER.pack(PROTOCOL_VERSION, MSG_UDP, tick) + UDP_TOKEN.pack(message['token'])
+    elif msgType in TIMESTAMPED:
+        return HEADER.pack(PROTOCOL_VERSION, TIMESTAMPED[msgType], tick) + TIMESTAMP.pack(message['time'])
+    raise ProtocolError(f'unknown message type {msgType!r}')
+
+def decode(payload):
+    try:
+        return _decode(payload)
+    except struct.error as e:
+        raise ProtocolError(f'malformed payload: {e}') from None
+
+def _decode(payload):
+    version, msgType, tick = HEADER.unpack_from(payload, 0)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'unsupported protocol version {version}')
+    offset = HEADER.size
+    if msgType == MSG_KEYFRAME:
+        snakes, offset = _unpack_snakes(payload, offset)
+        apples, offset = _unpack_apples(payload, offset)
+        return {'type': 'board_update', 'tick': tick, 'keyframe': True, 'snakes': snakes, 'apples': apples}
+    elif msgType == MSG_DELTA:
+        (count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        moves = []
+        for _ in range(count):
+            snake_id, direction, tails, headCount = MOVE.unpack_from(payload, offset)
+            heads, offset = unpack_cells(payload, offset + MOVE.size, headCount)
+            moves.append({'id': snake_id, 'heads': heads, 'tails': tails, 'direction': direction})
+        spawned, offset = _unpack_snakes(payload, offset)
+        (count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        dead = list(payload[offset:offset + count])
+        if len(dead) != count:
+            raise ProtocolError('truncated dead list')
+        apples, offset = _unpack_apples(payload, offset + count)
+        return {'type': 'board_update', 'tick': tick, 'keyframe': False,
+                'moves': moves, 'spawned': spawned, 'dead': dead, 'apples': apples}
+    elif msgType == MSG_DIRECTION:
+        direction, sent = DIRECTION.unpack_from(payload, offset)
+        return {'type': 'direction', 'tick': tick, 'direction': direction, 'sent': sent}
+    elif msgType == MSG_START:
+        snake_id, red, green, blue, token, count = START.unpack_from(payload, offset)
+        coords, offset = unpack_path(payload, offset + START.size, count)
+        return {'type': 'start', 'tick': tick, 'id': snake_id, 'coords': coords, 'color': (red, green, blue),
+                'token': token}
+    elif msgType == MSG_QUIT:
+        return {'type': 'quit', 'tick': tick}
+    elif msgType == MSG_RESYNC:
+        return {'type': 'resync', 'tick': tick}
+    elif msgType == MSG_JOIN:
+        match_id, token = JOIN.unpack_from(payload, offset)
+        return {'type': 'join', 'tick': tick, 'match': match_id, 'token': token}
+    elif msgType == MSG_GAME_OVER:
+        (winner,) = GAME_OVER.unpack_from(payload, offset)
+        return {'type': 'game_over', 'tick': tick, 'winner': None if winner == NO_WINNER else winner}
+    elif msgType == MSG_UDP:
+        (token,) = UDP_TOKEN.unpack_from(payload, offset)
+        return {'type': 'udp', 'tick': tick, 'token': token}
+    elif msgType in TIMESTAMPED_TYPES:
+        (timestamp,) = TIMESTAMP.unpack_from(payload, offset)
+        return {'type': TIMESTAMPED_TYPES[msgType], 'tick': tick, 'time': timestamp}
+    raise ProtocolError(f'unknown message type {msgType}')
+
+def frame(payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f'payload of {len(payload)} bytes does not fit in a frame')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def encode_frame(message):
+    return frame(encode(message))
+
+def iter_frames(data, offset=0):
+    # Payloads of the complete frames in data, as memoryviews; for datagrams, which are never split
+    view = memoryview(data)
+    while len(view) - offset >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if offset + length > len(view):
+            raise ProtocolError('truncated frame')
+        yield view[offset:offset + length]
+        offset += length
+
+def pack_state_datagram(sequence, frames):
+    return STATE_DATAGRAM.pack(sequence) + b''.join(frames)
+
+def unpack_state_datagram(data):
+    # Returns the sequence number and the list of update payloads, oldest first
+    if len(data) < STATE_DATAGRAM.size:
+        raise ProtocolError('truncated datagram')
+    (sequence,) = STATE_DATAGRAM.unpack_from(data)
+    return sequence, list(iter_frames(data, STATE_DATAGRAM.size))
+
+def pack_input_datagram(token, sequence, directions):
+    return INPUT_DATAGRAM.pack(token, sequence, len(directions)) + bytes(directions)
+
+def unpack_input_datagram(data):
+    # Returns the token, the sequence number of the newest input and the inputs, oldest first
+    if len(data) < INPUT_DATAGRAM.size:
+        raise ProtocolError('truncated datagram')
+    token, sequence, count = INPUT_DATAGRAM.unpack_from(data)
+    directions = list(data[INPUT_DATAGRAM.size:INPUT_DATAGRAM.size + count])
+    if len(directions) != count:
+        raise ProtocolError('truncated datagram')
+    return token, sequence, directions
+
+class FrameReader:
+    # Incremental frame parser for a socket. Data is received straight into one reused
+    # buffer with recv_into() and every complete frame is handed out as a memoryview of
+    # its payload, so nothing is re-scanned or copied per read. Only the trailing partial
+    # frame is ever moved, back to the front, once the free space runs out.
+    #
+    # The payload views point into the receive buffer: decode them before the next fill().
+
+    def __init__(self, size=2 * (FRAME_HEADER.size + MAX_FRAME_SIZE)):
+        self.buffer = bytearray(max(size, 2 * (FRAME_HEADER.size + MAX_FRAME_SIZE)))
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not handed out yet
+        self.end = 0    # end of the received data
+
+    def writable(self):
+        # Free space at the end of the buffer to receive into. Makes room by moving the
+        # pending partial frame to the front when less than one full frame would fit.
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < FRAME_HEADER.size + MAX_FRAME_SIZE:
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def commit(self, count):
+        # Marks count bytes written into writable() as received.
+        self.end += count
+
+    def fill(self, sock):
+        # Reads once from the socket, returns the number of bytes read (0 when the peer closed).
+        count = sock.recv_into(self.writable())
+        self.commit(count)
+        return count
+
+    def frames(self):
+        # Yields the payload of every complete frame received so far. Frames that are not
+        # iterated over stay queued for the next call.
+        while self.end - self.start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            frameEnd = self.start + FRAME_HEADER.size + length
+            if frameEnd > self.end:
+                return
+            payload = self.view[self.start + FRAME_HEADER.size:frameEnd]
+            self.start = frameEnd
+            yield payload
+
+def new_board():
+    # Local copy of the host's board, kept in sync by apply_board_update(). 'full' and 'changes'
+    # tell a renderer what happened since it last drew the board.
+    return {'tick': None, 'snakes': {}, 'apples': [], 'full': False, 'changes': []}
+
+def apply_board_update(board, message):
+    # Returns False when the update does not follow on the local board (a delta arrived after
+    # missed ticks); the board is then left untouched until the next keyframe resyncs it.
+    if message['keyframe']:
+        board['snakes'] = {
+            snake['id']: dict(snake, coords=deque(snake['coords'])) for snake in message['snakes']
+        }
+        board['apples'] = message['apples']
+        board['full'] = True
+        board['changes'] = []
+    elif board['tick'] is None or message['tick'] != board['tick'] + 1:
+        return False
+    else:
+        snakes = board['snakes']
+        changes = board['changes']
+        # cells are emptied before any are filled, so a head can move into a cell another
+        # snake's tail leaves in the same tick
+        for snake_id in message['dead']:
+            snake = snakes.pop(snake_id, None)
+            if snake is not None:
+                changes.extend((cell, None) for cell in snake['coords'])
+        for spawned in message['spawned']:
+            snake = snakes.get(spawned['id'])
+            if snake is not None:
+                changes.extend((cell, None) for cell in snake['coords'])
+        for move in message['moves']:
+            coords = snakes[move['id']]['coords']
+            for _ in range(move['tails']):
+                changes.append((coords.pop(), None))
+        apples = message['apples']
+        if apples != board['apples']:
+            changes.extend((cell, None) for cell in board['apples'] if cell not in apples)
+        for spawned in message['spawned']:
+            snakes[spawned['id']] = dict(spawned, coords=deque(spawned['coords']))
+            changes.extend((cell, spawned['color']) for cell in spawned['coords'])
+        for move in message['moves']:
+            snake = snakes[move['id']]
+            snake['coords'].extendleft(reversed(move['heads']))
+            snake['direction'] = move['direction']
+            changes.extend((cell, snake['color']) for cell in move['heads'])
+        if apples != board['apples']:
+            changes.extend((cell, APPLE_COLOR) for cell in apples if cell not in board['apples'])
+            board['apples'] = apples
+        if len(changes) > MAX_PENDING_CHANGES:
+            board['full'] = True
+            board['changes'] = []
+    board['tick'] = message['tick']
+    return True
+
+
+def self_check():
+    # Round-trips every message type, both datagram formats and the path packing, and checks
+    # that truncated or malformed input raises ProtocolError. Returns what failed, nothing when
+    # all is well; there are no assert statements, so python -O checks just as much.
+    failures = []
+
+    def round_trip(name, actual, expected):
+        if actual != expected:
+            failures.append(f'{name}: got {actual!r}, expected {expected!r}')
+
+    def rejects(name, function, *args):
+        try:
+            function(*args)
+        except ProtocolError:
+            return
+        except Exception as e:
+            failures.append(f'{name}: raised {type(e).__name__}: {e} instead of ProtocolError')
+            return
+        failures.append(f'{name}: no ProtocolError')
+
+    snake = {'id': 2, 'coords': [(5, 5), (5, 6), (4, 6), (4, 5)], 'color': (0, 255, 0), 'direction': 0}
+    spawned = {'id': 7, 'coords': [(70, 40), (71, 40), (72, 40)], 'color': (0, 0, 255), 'direction': 2}
+    messages = [
+        {'type': 'start', 'tick': 0, 'id': 2, 'coords': snake['coords'], 'color': (0, 255, 0), 'token': 0xDEADBEEF},
+        {'type': 'start', 'tick': 90, 'id': NO_SNAKE, 'coords': [], 'color': (0, 0, 0), 'token': 0},
+        {'type': 'join', 'tick': 0, 'match': 3, 'token': 12345},
+        {'type': 'quit', 'tick': 17},
+        {'type': 'resync', 'tick': 0},
+        {'type': 'game_over', 'tick': 400, 'winner': 2},
+        {'type': 'game_over', 'tick': 400, 'winner': None},
+        {'type': 'udp', 'tick': 0, 'token': 0xFFFFFFFF},
+        {'type': 'ping', 'tick': 5, 'time': 0xFFFFFFFF},
+        {'type': 'pong', 'tick': 5, 'time': 123},
+        {'type': 'input_applied', 'tick': 6, 'time': 456},
+        {'type': 'direction', 'tick': 0, 'direction': 3, 'sent': 789},
+        {'type': 'board_update', 'tick': 30, 'keyframe': True, 'snakes': [snake, spawned], 'apples': [(3, 4), (79, 44)]},
+        {'type': 'board_update', 'tick': 30, 'keyframe': True, 'snakes': [], 'apples': []},
+        {'type': 'board_update', 'tick': 31, 'keyframe': False,
+         'moves': [{'id': 2, 'heads': [(5, 3), (5, 4)], 'tails': 2, 'direction': 0},
+                   {'id': 4, 'heads': [], 'tails': 0, 'direction': 1}],
+         'spawned': [spawned], 'dead': [1, 3], 'apples': [(10, 10)]},
+        {'type': 'board_update', 'tick': 32, 'keyframe': False, 'moves': [], 'spawned': [], 'dead': [], 'apples': []},
+    ]
+    for message in messages:
+        name = f"{message['type']} of tick {message['tick']}"
+        try:
+            payload = encode(message)
+            round_trip(name, decode(payload), message)
+            round_trip(f'{name} in a frame', [decode(framed) for framed in iter_frames(frame(payload))], [message])
+        except ProtocolError as e:
+            failures.append(f'{name}: {e}')
+            continue
+        # every cut short payload is refused, never decoded into something else
+        for length in range(len(payload)):
+            rejects(f'{name} cut to {length} bytes', decode, payload[:length])
+        rejects(f'{name} of another version', decode, bytes([PROTOCOL_VERSION + 1]) + payload[1:])
+
+    updates = [encode(message) for message in messages if message['type'] == 'board_update']
+    sequence, payloads = unpack_state_datagram(pack_state_datagram(0xFFFFFFFF, [frame(update) for update in updates]))
+    round_trip('state datagram', (sequence, [bytes(payload) for payload in payloads]), (0xFFFFFFFF, updates))
+    round_trip('empty state datagram', unpack_state_datagram(pack_state_datagram(1, [])), (1, []))
+    round_trip('input datagram', unpack_input_datagram(pack_input_datagram(0xDEADBEEF, 42, [0, 3, 1])),
+               (0xDEADBEEF, 42, [0, 3, 1]))
+    round_trip('empty input datagram', unpack_input_datagram(pack_input_datagram(1, 0, [])), (1, 0, []))
+    state = pack_state_datagram(9, [frame(updates[0])])
+    for length in (0, STATE_DATAGRAM.size - 1, len(state) - 1):
+        rejects(f'state datagram cut to {length} bytes', unpack_state_datagram, state[:length])
+    inputs = pack_input_datagram(1, 2, [0, 1])
+    for length in (0, INPUT_DATAGRAM.size - 1, len(inputs) - 1):
+        rejects(f'input datagram cut to {length} bytes', unpack_input_datagram, inputs[:length])
+
+    paths = [
+        [(0, 0)],
+        [(1, 1), (2, 1), (2, 2), (1, 2), (0, 2), (0, 1)], # every direction
+        [(255, 255), (254, 255), (254, 254), (255, 254)], # along the far edges of the cell range
+        [(k % 80 if k // 80 % 2 == 0 else 79 - k % 80, k // 80) for k in range(80 * 45)],
+    ]
+    for coords in paths:
+        name = f'path of {len(coords)} cells from {coords[0]}'
+        try:
+            packed = pack_path(coords)
+            round_trip(name, unpack_path(packed, 0, len(coords)), (coords, len(packed)))
+        except ProtocolError as e:
+            failures.append(f'{name}: {e}')
+            continue
+        rejects(f'{name} cut short', unpack_path, packed[:-1], 0, len(coords))
+    round_trip('empty path', (pack_path([]), unpack_path(b'', 0, 0)), (b'', ([], 0)))
+    rejects('path with a gap', pack_path, [(0, 0), (2, 0)])
+    rejects('path jumping from x 255 to x 0', pack_path, [(255, 3), (0, 3)])
+    rejects('path off the cell range', pack_path, [(256, 0), (255, 0)])
+
+    rejects('unknown message type', decode, HEADER.pack(PROTOCOL_VERSION, 0xFF, 0))
+    rejects('encoding an unknown message type', encode, {'type': 'teleport'})
+    rejects('apple off the cell range', encode,
+            {'type': 'board_update', 'tick': 0, 'keyframe': True, 'snakes': [], 'apples': [(300, 0)]})
+    rejects('payload too long for a frame', frame, bytes(MAX_FRAME_SIZE + 1))
+    return failures
+
+
+def compare_with_json(snakeCount=8, snakeLength=100, rounds=2000):
+    # Size and encode/decode throughput of the binary format against the old JSON text messages.
+    import json
+    import time
+
+    def winding(row, length):
+        # a body running along rows, turning at the edges of the 80x45 board
+        return [(k % 80 if k // 80 % 2 == 0 else 79 - k % 80, row + k // 80) for k in range(length)]
+
+    snakes = [
+        {'id': i, 'coords': winding(i * 5, snakeLength), 'color': (255, 0, 0), 'direction': 3}
+        for i in range(snakeCount)
+    ]
+    fullBoard = [{'id': 0, 'coords': winding(0, 80 * 45), 'color': (255, 0, 0), 'direction': 3}]
+    samples = {
+        'keyframe': {'type': 'board_update', 'tick': 1, 'keyframe': True, 'snakes': snakes, 'apples': [(3, 4)]},
+        'full board': {'type': 'board_update', 'tick': 1, 'keyframe': True, 'snakes': fullBoard, 'apples': []},
+        'delta': {'type': 'board_update', 'tick': 2, 'keyframe': False,
+                  'moves': [{'id': s['id'], 'heads': [s['coords'][0]], 'tails': 1, 'direction': 3} for s in snakes],
+                  'spawned': [], 'dead': [], 'apples': [(3, 4)]},
+        'direction': {'type': 'direction', 'tick': 0, 'direction': 0, 'sent': 12345},
+    }
+    for name, message in samples.items():
+        binary = encode(message)
+        text = json.dumps(message).encode()
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decode(encode(message))
+        binaryTime = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            json.loads(json.dumps(message).encode())
+        jsonTime = (time.perf_counter() - start) / rounds
+
+        print(f"{name:>10}: binary {len(binary):6d} B {binaryTime * 1e6:8.1f} us | "
+              f"json {len(text):6d} B {jsonTime * 1e6:8.1f} us")
+
+
+if __name__ == '__main__':
+    failures = self_check()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if failures:
+        sys.exit(1)
+    print("protocol self-check passed")
+    compare_with_json()
@@ -0,0 +1,94 @@
+# Networmy board renderer
+# Shared by the host's projector view and the client. The empty board (background colour and
+# grid lines) is rendered once into a cached surface and every snake colour gets a pre-rendered
+# segment tile. A frame then only blits the cells that changed and hands just those rects to
+# pygame.display.update().
+
+import pygame
+
+from networmy_protocol import APPLE_COLOR
+
+
+def darker(color):
+    return tuple(channel * 2 // 3 for channel in color)
+
+
+class BoardRenderer:
+
+    def __init__(self, surface, cellSize, bgColor, gridColor, innerColor=darker):
+        self.surface = surface
+        self.cellSize = cellSize
+        self.innerColor = innerColor
+        self.background = pygame.Surface(surface.get_size()).convert()
+        self.background.fill(bgColor)
+        width, height = surface.get_size()
+        for x in range(0, width, cellSize):  # draw vertical lines
+            pygame.draw.line(self.background, gridColor, (x, 0), (x, height))
+        for y in range(0, height, cellSize):  # draw horizontal lines
+            pygame.draw.line(self.background, gridColor, (0, y), (width, y))
+        self.tiles = {}   # snake colour -> segment tile
+        self.drawn = {}   # (x, y) -> colour of the segment currently drawn on that cell
+        self.dirty = []   # rects changed since the last flush()
+
+    def tile(self, color):
+        tile = self.tiles.get(color)
+        if tile is None:
+            tile = pygame.Surface((self.cellSize, self.cellSize)).convert()
+            tile.fill(color)
+            if color != APPLE_COLOR: # apples are plain tiles, snake segments have an inner square
+                inner = pygame.Rect(4, 4, self.cellSize - 8, self.cellSize - 8)
+                pygame.draw.rect(tile, self.innerColor(color), inner)
+            self.tiles[color] = tile
+        return tile
+
+    def reset(self):
+        # Repaints the whole empty board, e.g. after another screen used the display
+        self.surface.blit(self.background, (0, 0))
+        self.drawn = {}
+        self.dirty = [self.surface.get_rect()]
+
+    def draw_cell(self, cell, color):
+        if self.drawn.get(cell) == color:
+            return
+        rect = pygame.Rect(cell[0] * self.cellSize, cell[1] * self.cellSize, self.cellSize, self.cellSize)
+        if color is None:
+            del self.drawn[cell]
+            self.surface.blit(self.background, rect, rect)
+        else:
+            self.drawn[cell] = color
+            self.surface.blit(self.tile(color), rect)
+        self.dirty.append(rect)
+
+    def draw_changes(self, changes):
+        # changes is a sequence of (cell, colour) in the order they happened, colour None for
+        # a cell that became empty
+        for cell, color in changes:
+            self.draw_cell(cell, color)
+
+    def draw_snakes(self, snakes):
+        # Brings the screen in line with a full board, given as (cells, colour) per snake, only
+        # redrawing the cells that differ
+        wanted = {}
+        for cells, color in snakes:
+            for cell in cells:
+                wanted[cell] = color
+        for cell in [cell for cell in self.drawn if cell not in wanted]:
+            self.draw_cell(cell, None)
+        for cell, color in wanted.items():
+            self.draw_cell(cell, color)
+
+    def draw_board(self, board):
+        # Draws what changed on a board kept by networmy_protocol.apply_board_update()
+        if board['full']:
+            self.draw_snakes([(snake['coords'], snake['color']) for snake in board['snakes'].values()]
+                             + [(board['apples'], APPLE_COLOR)])
+        else:
+            self.draw_changes(board['changes'])
+        board['full'] = False
+        board['changes'] = []
+
+    def flush(self):
+        # Pushes the changed rects to the display
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []
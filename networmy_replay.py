@@ -0,0 +1,317 @@
+# Networmy match recordings
+# A recording holds what it takes to re-simulate a match with networmy_game.Game: the seed, the
+# turns the snakes actually took on every tick and, every keyframe interval, the full state of
+# the board. Turns are all a tick adds, so recording costs a few bytes per tick; a writer thread
+# does the file I/O.
+#
+#   file     = header + records + index + trailer
+#   header   = magic "NWRP", version, board width and height, cell type code, seed, keyframe interval,
+#              number of apples
+#   record   = type (uint8) + tick (uint32) + body length (uint32) + body
+#   turns    = (snake id uint16, direction uint8) per snake that turned on that tick
+#   keyframe = random generator state + snake count (uint16)
+#              + per snake: id, direction, colour (flag + 3 bytes), length, head cell index,
+#                then the rest of the body as a path (networmy_game.encode_path())
+#              + apple count (uint16) + apple cell indices
+#              + free cell count (uint32) + free cell indices, in the order the grid keeps them
+#   end      = the last tick, no body
+#   index    = (tick uint32, offset uint64) per keyframe, found through the trailer
+#
+# Keyframes are written on every multiple of the interval, so the keyframe before any tick is
+# found in the index by a division. Recordings of a host that did not shut down cleanly have no
+# index; it is rebuilt by scanning the records.
+#
+#   python networmy_replay.py MATCH.nwr             replays the whole match, as fast as it goes
+#   python networmy_replay.py MATCH.nwr --seek 120  shows the board at tick 120
+#   python networmy_replay.py MATCH.nwr --verify    checks the re-simulation against every keyframe
+
+import argparse
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from networmy_game import Game, Snake, encode_path, decode_path
+
+RECORDING_VERSION = 5
+
+FILE_HEADER = struct.Struct('<4sBHHcIHH') # magic, version, width, height, cell type code, seed, keyframe interval, apples
+RECORD = struct.Struct('<BII')           # type, tick, body length
+TURN = struct.Struct('<HB')              # snake id, direction
+SNAKE_COUNT = struct.Struct('<H')
+FREE_COUNT = struct.Struct('<I')
+SNAKE_RECORD = struct.Struct('<HBB3BI')  # id, direction, has colour, colour, length
+INDEX_ENTRY = struct.Struct('<IQ')       # tick, offset of the keyframe record
+TRAILER = struct.Struct('<4sQI')         # magic, offset of the index, number of entries
+
+REC_TURNS = 1
+REC_KEYFRAME = 2
+REC_END = 3
+
+RANDOM_STATE_WORDS = 625 # the Mersenne Twister state of random.Random.getstate()
+NO_TURNS = {}
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+def _from_little_endian(typecode, data):
+    values = array(typecode, data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class Recorder:
+    # Records a game as it is played: call record() after every step and close() at the end.
+    # The tick only packs a few bytes into a buffer; full buffers and keyframes are handed to
+    # a writer thread.
+
+    def __init__(self, path, game, keyframeInterval, flushSize=64 * 1024):
+        self.keyframeInterval = keyframeInterval
+        self.flushSize = flushSize
+        self.typecode = 'H' if game.width * game.height <= 0x10000 else 'I'
+        self.file = open(path, 'wb')
+        self.buffer = bytearray(FILE_HEADER.pack(b'NWRP', RECORDING_VERSION, game.width, game.height,
+                                                 self.typecode.encode(), game.seed, keyframeInterval, game.appleCount))
+        self.written = 0 # bytes handed to the writer thread
+        self.index = []  # (tick, offset) per keyframe
+        self.tick = game.tick
+        self.closed = False
+        self.chunks = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        self.keyframe(game)
+
+    def record(self, game):
+        self.tick = game.tick
+        if game.turns:
+            self.buffer += RECORD.pack(REC_TURNS, game.tick, TURN.size * len(game.turns))
+            for turn in game.turns:
+                self.buffer += TURN.pack(*turn)
+        if game.tick % self.keyframeInterval == 0:
+            self.keyframe(game)
+        elif len(self.buffer) >= self.flushSize:
+            self.flush()
+
+    def keyframe(self, game):
+        version, words, gauss = game.random.getstate()
+        parts = [_little_endian(array('I', words)).tobytes(), SNAKE_COUNT.pack(len(game.snakes))]
+        for snake in game.snakes:
+            color = snake.color or (0, 0, 0)
+            parts.append(SNAKE_RECORD.pack(snake.id, snake.direction, snake.color is not None, *color, len(snake)))
+            cells = snake.cells()
+            parts.append(_little_endian(array(self.typecode, cells[:1])).tobytes())
+            parts.append(encode_path(cells, game.width))
+        parts.append(SNAKE_COUNT.pack(len(game.apples)))
+        parts.append(_little_endian(array(self.typecode, sorted(game.apples))).tobytes())
+        # which cell the game draws for an apple or a spawn depends on the order of the free set
+        free = game.grid.free_cells()
+        parts.append(FREE_COUNT.pack(len(free)))
+        parts.append(_little_endian(free).tobytes())
+        body = b''.join(parts)
+        self.index.append((game.tick, self.written + len(self.buffer)))
+        self.buffer += RECORD.pack(REC_KEYFRAME, game.tick, len(body))
+        self.buffer += body
+        self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.chunks.put(bytes(self.buffer))
+            self.written += len(self.buffer)
+            self.buffer = bytearray()
+
+    def write_loop(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            self.file.write(chunk)
+        self.file.close()
+
+    def close(self):
+        # Ends the recording with the last recorded tick and the keyframe index
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer += RECORD.pack(REC_END, self.tick, 0)
+        indexOffset = self.written + len(self.buffer)
+        for entry in self.index:
+            self.buffer += INDEX_ENTRY.pack(*entry)
+        self.buffer += TRAILER.pack(b'NWRI', indexOffset, len(self.index))
+        self.flush()
+        self.chunks.put(None)
+        self.writer.join()
+
+
+class Replay:
+    # A recording opened for replay. The file is memory-mapped, so seeking only touches the
+    # keyframe it starts from and the records after it.
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width, self.height, typecode, self.seed, self.keyframeInterval, self.appleCount = \
+            FILE_HEADER.unpack_from(self.data, 0)
+        if magic != b'NWRP' or version != RECORDING_VERSION:
+            raise ValueError(f'{path} is not a networmy recording this version can read')
+        self.typecode = typecode.decode()
+        self.end = len(self.data) # where the records stop
+        magic, indexOffset, count = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+        if magic == b'NWRI':
+            self.index = list(INDEX_ENTRY.iter_unpack(self.data[indexOffset:indexOffset + count * INDEX_ENTRY.size]))
+            self.end = indexOffset
+        else:
+            self.index = [(tick, offset) for recordType, tick, body, length, offset in self.records(FILE_HEADER.size)
+                          if recordType == REC_KEYFRAME]
+
+    def close(self):
+        self.data.close()
+
+    def records(self, offset):
+        # Yields (type, tick, body offset, body length, record offset) from offset on; stops at
+        # the end record or at a record cut short by a crash of the host
+        while offset + RECORD.size <= self.end:
+            recordType, tick, length = RECORD.unpack_from(self.data, offset)
+            body = offset + RECORD.size
+            if body + length > self.end:
+                return
+            yield recordType, tick, body, length, offset
+            if recordType == REC_END:
+                return
+            offset = body + length
+
+    def last_tick(self):
+        # Ticks after the last keyframe are only known by reading their records
+        tick = self.index[-1][0]
+        for recordType, recordTick, body, length, offset in self.records(self.index[-1][1]):
+            tick = recordTick
+        return tick
+
+    def keyframe(self, offset):
+        # The game as stored in the keyframe record at offset
+        recordType, tick, length = RECORD.unpack_from(self.data, offset)
+        body = offset + RECORD.size
+        game = Game(self.width, self.height, self.seed, self.appleCount)
+        words = _from_little_endian('I', self.data[body:body + 4 * RANDOM_STATE_WORDS])
+        game.random.setstate((3, tuple(words), None))
+        body += 4 * RANDOM_STATE_WORDS
+        (count,) = SNAKE_COUNT.unpack_from(self.data, body)
+        body += SNAKE_COUNT.size
+        itemsize = array(self.typecode).itemsize
+        for _ in range(count):
+            snake_id, direction, hasColor, red, green, blue, cellCount = SNAKE_RECORD.unpack_from(self.data, body)
+            body += SNAKE_RECORD.size
+            (head,) = _from_little_endian(self.typecode, self.data[body:body + itemsize])
+            body += itemsize
+            pathLength = (cellCount + 2) // 4
+            cells = decode_path(head, self.data[body:body + pathLength], cellCount, self.width)
+            body += pathLength
+            color = (red, green, blue) if hasColor else None
+            game.add_snake(Snake(snake_id, cells, direction, color, self.width * self.height, self.typecode))
+        (count,) = SNAKE_COUNT.unpack_from(self.data, body)
+        body += SNAKE_COUNT.size
+        for cell in _from_little_endian(self.typecode, self.data[body:body + itemsize * count]):
+            game.grid.reserve(cell)
+            game.apples.add(cell)
+        body += itemsize * count
+        (count,) = FREE_COUNT.unpack_from(self.data, body)
+        body += FREE_COUNT.size
+        game.grid.restore_free(_from_little_endian(self.typecode, self.data[body:body + itemsize * count]))
+        game.tick = tick
+        return game
+
+    def seek(self, tick):
+        # The game at the given tick (or at the end of the match if that comes first): a keyframe
+        # from the index plus at most one keyframe interval of re-simulation
+        position = min(max(tick, 0) // self.keyframeInterval, len(self.index) - 1)
+        while position > 0 and self.index[position][0] > tick:
+            position -= 1 # only when the recording did not start on tick 0
+        keyframeTick, offset = self.index[position]
+        game = self.keyframe(offset)
+        self.run(game, offset, until=tick)
+        return game
+
+    def run(self, game, offset, until=None, on_keyframe=None, on_crash=None):
+        # Re-simulates game, which is at the keyframe at offset, with the recorded turns up to
+        # tick until (the end without one). on_keyframe(game, offset) is called on every later
+        # keyframe once the game has reached it, on_crash(tick, snake, reason) for every crash.
+        def advance_to(tick, turns=None):
+            while game.tick < tick:
+                # turns only on the recorded tick, never the inputs of the game
+                for snake, reason in game.step(turns if turns and game.tick == tick - 1 else NO_TURNS):
+                    if on_crash is not None:
+                        on_crash(game.tick, snake, reason)
+
+        for recordType, tick, body, length, recordOffset in self.records(offset):
+            if recordOffset == offset:
+                continue
+            if until is not None and tick > until:
+                advance_to(until)
+                return
+            if recordType == REC_TURNS:
+                advance_to(tick, dict(TURN.iter_unpack(self.data[body:body + length])))
+            elif recordType == REC_KEYFRAME:
+                advance_to(tick)
+                if on_keyframe is not None:
+                    on_keyframe(game, recordOffset)
+            elif recordType == REC_END:
+                advance_to(tick if until is None else min(tick, until))
+
+    def verify(self):
+        # Re-simulates the whole match from its first keyframe and returns the ticks of the
+        # keyframes the re-simulation disagrees with; empty when the replay is deterministic
+        mismatches = []
+
+        def check(game, offset):
+            stored = self.keyframe(offset)
+            same = (stored.random.getstate() == game.random.getstate() and stored.apples == game.apples and
+                    stored.grid.free_cells() == game.grid.free_cells() and
+                    [(snake.id, snake.direction, list(snake.cells())) for snake in stored.snakes] ==
+                    [(snake.id, snake.direction, list(snake.cells())) for snake in game.snakes])
+            if not same:
+                mismatches.append(game.tick)
+
+        tick, offset = self.index[0]
+        self.run(self.keyframe(offset), offset, on_keyframe=check)
+        return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded networmy match.')
+    parser.add_argument('recording')
+    parser.add_argument('--seek', type=int, metavar='TICK', help='show the board at TICK')
+    parser.add_argument('--verify', action='store_true', help='check the re-simulation against every keyframe')
+    args = parser.parse_args()
+
+    replay = Replay(args.recording)
+    print(f"{replay.width}x{replay.height} board, seed {replay.seed}, "
+          f"{len(replay.index)} keyframes, last tick {replay.last_tick()}")
+    if args.seek is not None:
+        start = time.perf_counter()
+        game = replay.seek(args.seek)
+        print(f"tick {game.tick} (seek took {(time.perf_counter() - start) * 1000:.2f} ms)")
+        for snake in game.snakes:
+            print(f"  snake {snake.id}: head {game.grid.coords[snake.cell(0)]}, length {len(snake)}, direction {snake.direction}")
+    elif args.verify:
+        mismatches = replay.verify()
+        print("replay matches every keyframe" if not mismatches else f"replay differs at ticks {mismatches}")
+    else:
+        tick, offset = replay.index[0]
+        game = replay.keyframe(offset)
+        start = time.perf_counter()
+        replay.run(game, offset, on_crash=lambda tick, snake, reason:
+                   print(f"tick {tick}: snake {snake.id} collided with {reason}"))
+        elapsed = time.perf_counter() - start
+        print(f"replayed {game.tick - tick} ticks in {elapsed:.3f} s ({(game.tick - tick) / max(elapsed, 1e-9):.0f} ticks/s)")
+    replay.close()
+
+
+if __name__ == '__main__':
+    main()